@@ -0,0 +1,76 @@
+# Compare the per-element splitter with the packed chunker on parsed markdown files.
+#
+#   python airflow/benchmarks/compare_chunkers.py downloads/<document_id>/parsed_documents/<name>.md [...]
+#
+# Reports vector counts, chunk sizes and chunking time for each CHUNKING_MODE. With --embed the chunks are
+# also embedded (embedding cache disabled) so the embedding time of both modes can be compared.
+
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pipeline
+
+CHUNKING_MODES = ["element", "packed"]
+
+def benchmark_chunking_mode(markdown_file_paths, chunking_mode, embed = False):
+    texts = []
+    start_time = time.perf_counter()
+    for markdown_file_path in markdown_file_paths:
+        chunk_texts, _ = pipeline._load_markdown_chunks(markdown_file_path, chunking_mode)
+        texts.extend(chunk_texts)
+    chunking_seconds = time.perf_counter() - start_time
+
+    token_counts = pipeline._count_tokens(texts)
+    result = {
+        'mode'              : chunking_mode,
+        'vectors'           : len(texts),
+        'tokens'            : sum(token_counts),
+        'median_tokens'     : statistics.median(token_counts) if token_counts else 0,
+        'max_tokens'        : max(token_counts, default = 0),
+        'chunking_seconds'  : chunking_seconds,
+        'embedding_seconds' : None
+    }
+
+    if embed and texts:
+        start_time = time.perf_counter()
+        pipeline.create_embeddings_in_batches(pipeline._create_embedding_model(), texts)
+        result['embedding_seconds'] = time.perf_counter() - start_time
+
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description = "Compare chunking modes on parsed markdown files")
+    parser.add_argument("markdown_files", nargs = "+", help = "Markdown files produced by the doc parser")
+    parser.add_argument("--embed", action = "store_true", help = "Also embed the chunks and time it (calls the OpenAI API)")
+    parser.add_argument("--json", dest = "json_path", help = "Write the results to this JSON file")
+    args = parser.parse_args()
+
+    # Measure real embedding calls, not cache hits
+    os.environ["EMBEDDING_CACHE_ENABLED"] = "false"
+
+    results = [benchmark_chunking_mode(args.markdown_files, chunking_mode, args.embed) for chunking_mode in CHUNKING_MODES]
+
+    print(f"{'mode':<10}{'vectors':>10}{'tokens':>10}{'median':>10}{'max':>8}{'chunk s':>10}{'embed s':>10}")
+    for result in results:
+        embedding_seconds = f"{result['embedding_seconds']:.2f}" if result['embedding_seconds'] is not None else "-"
+        print(
+            f"{result['mode']:<10}{result['vectors']:>10}{result['tokens']:>10}{result['median_tokens']:>10.0f}"
+            f"{result['max_tokens']:>8}{result['chunking_seconds']:>10.2f}{embedding_seconds:>10}"
+        )
+
+    element_result, packed_result = results
+    if element_result['vectors']:
+        print(f"packed mode stores {100 * (1 - packed_result['vectors'] / element_result['vectors']):.1f}% fewer vectors")
+
+    if args.json_path:
+        with open(args.json_path, "w") as fp:
+            json.dump(results, fp, indent = 2)
+
+if __name__ == "__main__":
+    main()
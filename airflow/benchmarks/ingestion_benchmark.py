@@ -0,0 +1,250 @@
+# Ingestion benchmark against local stand-ins for S3, OpenAI and Pinecone.
+#
+#   python airflow/benchmarks/ingestion_benchmark.py samples/*.pdf --vision-latency 0.5 --json report.json
+#
+# Every sample PDF becomes a document in an in-process S3 bucket, then pipeline.main() runs each document
+# through the download -> parse -> summarize -> embed -> upsert stages. Parsing is real (Docling); the vision
+# summarizer, the embedding model and the vector index are deterministic fakes patched in through the
+# pipeline's client helpers, with configurable latency. The report lists wall time, throughput and the peak
+# RSS high-water mark per stage. Caches live in a fresh work directory, so every run starts cold.
+
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import tempfile
+import resource
+import threading
+from types import SimpleNamespace
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pipeline
+
+BENCHMARK_BUCKET = "benchmark-bucket"
+
+class FakeS3Client:
+    # The subset of the boto3 S3 client the pipeline uses, backed by a dict of key -> bytes
+
+    def __init__(self, objects):
+        self.objects = objects
+        self._lock = threading.Lock()
+
+    def _describe(self, key):
+        body = self.objects[key]
+        return {'Key': key, 'Size': len(body), 'ETag': f'"{hashlib.md5(body).hexdigest()}"'}
+
+    def get_paginator(self, operation_name):
+        return self
+
+    def paginate(self, Bucket, Prefix = "", Delimiter = None):
+        with self._lock:
+            keys = sorted(key for key in self.objects if key.startswith(Prefix))
+        if Delimiter:
+            prefixes = sorted({key[:len(Prefix)] + key[len(Prefix):].split(Delimiter)[0] + Delimiter for key in keys if Delimiter in key[len(Prefix):]})
+            yield {'CommonPrefixes': [{'Prefix': prefix} for prefix in prefixes]}
+        else:
+            yield {'Contents': [self._describe(key) for key in keys]}
+
+    def download_file(self, Bucket, Key, Filename, Config = None):
+        with open(Filename, "wb") as fp:
+            fp.write(self.objects[Key])
+
+    def upload_file(self, Filename, Bucket, Key, Config = None):
+        with open(Filename, "rb") as fp:
+            body = fp.read()
+        with self._lock:
+            self.objects[Key] = body
+
+class FakeEmbeddingModel:
+    # Deterministic unit vectors seeded by the text hash, so identical texts always get identical vectors
+
+    def __init__(self, dimension, latency):
+        self.model = pipeline.EMBEDDING_MODEL
+        self.dimensions = dimension
+        self.latency = latency
+
+    def embed_documents(self, texts):
+        time.sleep(self.latency)
+        vectors = []
+        for text in texts:
+            seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+            vector = np.random.default_rng(seed).standard_normal(self.dimensions)
+            vectors.append((vector / np.linalg.norm(vector)).tolist())
+        return vectors
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+class FakeIndex:
+    def __init__(self, dimension):
+        self.dimension = dimension
+        self.namespaces = {}
+        self._lock = threading.Lock()
+
+    def upsert(self, vectors, namespace = ""):
+        with self._lock:
+            stored = self.namespaces.setdefault(namespace, {})
+            for vector in vectors:
+                if len(vector['values']) != self.dimension:
+                    raise ValueError(f"Vector dimension {len(vector['values'])} does not match the index dimension {self.dimension}")
+                stored[vector['id']] = vector
+
+    def delete(self, ids, namespace = ""):
+        with self._lock:
+            stored = self.namespaces.get(namespace, {})
+            for vector_id in ids:
+                stored.pop(vector_id, None)
+
+    def list(self, prefix = None, namespace = ""):
+        with self._lock:
+            ids = sorted(vector_id for vector_id in self.namespaces.get(namespace, {}) if not prefix or vector_id.startswith(prefix))
+        for start in range(0, len(ids), 100):
+            yield ids[start:start + 100]
+
+    def vector_count(self):
+        return sum(len(stored) for stored in self.namespaces.values())
+
+class FakePinecone:
+    def __init__(self):
+        self.indexes = {}
+
+    def list_indexes(self):
+        return SimpleNamespace(names = lambda: list(self.indexes))
+
+    def describe_index(self, name):
+        return SimpleNamespace(dimension = self.indexes[name].dimension, status = {'ready': True})
+
+    def create_index(self, name, dimension, metric, spec):
+        self.indexes[name] = FakeIndex(dimension)
+
+    def delete_index(self, name):
+        del self.indexes[name]
+
+    def Index(self, name):
+        return self.indexes[name]
+
+def make_fake_image_summarize(latency):
+    def image_summarize(img_base64, prompt, max_retries = None, mime_type = "image/jpeg"):
+        time.sleep(latency)
+        return f"Summary of image {hashlib.sha256(img_base64.encode('utf-8')).hexdigest()[:16]}"
+    return image_summarize
+
+def peak_rss_mb():
+    # ru_maxrss is a high-water mark in KB on Linux; parse workers show up under RUSAGE_CHILDREN
+    return (
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    )
+
+def stage_units(stage_name, document_id, stage_result):
+    # Work done by one stage for one document, in the unit its throughput is reported in
+    document_dir = pipeline._get_document_dir(document_id)
+    if stage_name == "download":
+        return (stage_result or {}).get('bytes', 0) / (1024 * 1024), "MB"
+    if stage_name == "parse":
+        return sum(len(pipeline._pdf_page_sizes(pdf_path)) for pdf_path in document_dir.glob("*.pdf")), "pages"
+    if stage_name == "summarize":
+        return len(pipeline._read_stage_output(document_id, "summaries.json")['summaries']), "summaries"
+    if stage_name in ("embed", "upsert"):
+        return len(pipeline._read_stage_output(document_id, "embedding_plan.json")['new_ids']), "vectors"
+    return 0, ""
+
+def run_benchmark(pdf_paths, vision_latency, embedding_latency):
+    objects = {}
+    for pdf_ix, pdf_path in enumerate(pdf_paths):
+        with open(pdf_path, "rb") as fp:
+            objects[f"bench{pdf_ix:03d}/{os.path.basename(pdf_path)}"] = fp.read()
+
+    fake_s3 = FakeS3Client(objects)
+    fake_pinecone = FakePinecone()
+
+    pipeline._create_s3_client = lambda max_pool_connections = 10: fake_s3
+    pipeline._create_pinecone_client = lambda: fake_pinecone
+    pipeline._create_embedding_model = lambda: FakeEmbeddingModel(pipeline._get_embedding_dimension(), embedding_latency)
+    pipeline.image_summarize = make_fake_image_summarize(vision_latency)
+
+    stage_names = ["download", "parse", "summarize", "embed", "upsert"]
+    stage_stats = {stage_name: {'seconds': 0.0, 'units': 0, 'unit': "", 'peak_rss_mb': 0.0, 'peak_child_rss_mb': 0.0} for stage_name in stage_names}
+
+    def timed_stage(stage_name, stage):
+        def run_stage(document_id):
+            start_time = time.perf_counter()
+            stage_result = stage(document_id)
+            elapsed = time.perf_counter() - start_time
+
+            units, unit = stage_units(stage_name, document_id, stage_result)
+            rss_mb, child_rss_mb = peak_rss_mb()
+            stats = stage_stats[stage_name]
+            stats['seconds'] += elapsed
+            stats['units'] += units
+            stats['unit'] = unit
+            stats['peak_rss_mb'] = max(stats['peak_rss_mb'], rss_mb)
+            stats['peak_child_rss_mb'] = max(stats['peak_child_rss_mb'], child_rss_mb)
+            return stage_result
+        return run_stage
+
+    pipeline.DOCUMENT_STAGES[:] = [timed_stage(stage_name, stage) for stage_name, stage in zip(stage_names, pipeline.DOCUMENT_STAGES)]
+
+    start_time = time.perf_counter()
+    pipeline.main()
+    total_seconds = time.perf_counter() - start_time
+
+    for stats in stage_stats.values():
+        stats['throughput'] = stats['units'] / stats['seconds'] if stats['seconds'] else 0.0
+
+    return {
+        'documents'     : len(pdf_paths),
+        'total_seconds' : total_seconds,
+        'documents_per_second': len(pdf_paths) / total_seconds if total_seconds else 0.0,
+        'vectors'       : sum(index.vector_count() for index in fake_pinecone.indexes.values()),
+        'stages'        : stage_stats
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description = "Benchmark the ingestion pipeline against local fakes")
+    parser.add_argument("pdfs", nargs = "+", help = "Sample PDF files, one document each")
+    parser.add_argument("--vision-latency", type = float, default = 0.0, help = "Seconds each fake vision call takes")
+    parser.add_argument("--embedding-latency", type = float, default = 0.0, help = "Seconds each fake embedding request takes")
+    parser.add_argument("--keep-workdir", action = "store_true", help = "Keep the temporary work directory")
+    parser.add_argument("--json", dest = "json_path", help = "Write the report to this JSON file")
+    args = parser.parse_args()
+
+    pdf_paths = [os.path.abspath(pdf_path) for pdf_path in args.pdfs]
+    json_path = os.path.abspath(args.json_path) if args.json_path else None
+
+    # Everything the pipeline writes goes to a throwaway directory: downloads, parse outputs and caches
+    work_dir = tempfile.mkdtemp(prefix = "ingestion-benchmark-")
+    os.chdir(work_dir)
+    os.environ.update({
+        'S3_BUCKET_NAME'        : BENCHMARK_BUCKET,
+        'DOWNLOAD_DIRECTORY'    : "downloads",
+        'SUMMARY_CACHE_DIR'     : os.path.join(work_dir, ".summary_cache"),
+        'EMBEDDING_CACHE_DIR'   : os.path.join(work_dir, ".embedding_cache")
+    })
+    # A document list from .env would hide the benchmark documents
+    os.environ.pop("S3_DOCUMENT_IDS", None)
+
+    try:
+        report = run_benchmark(pdf_paths, args.vision_latency, args.embedding_latency)
+    finally:
+        if not args.keep_workdir:
+            shutil.rmtree(work_dir, ignore_errors = True)
+
+    print(f"{report['documents']} documents in {report['total_seconds']:.2f}s ({report['documents_per_second']:.2f} documents/s), {report['vectors']} vectors")
+    print(f"{'stage':<12}{'seconds':>10}{'throughput':>22}{'peak RSS MB':>14}{'workers MB':>12}")
+    for stage_name, stats in report['stages'].items():
+        throughput = f"{stats['throughput']:.2f} {stats['unit']}/s"
+        print(f"{stage_name:<12}{stats['seconds']:>10.2f}{throughput:>22}{stats['peak_rss_mb']:>14.0f}{stats['peak_child_rss_mb']:>12.0f}")
+
+    if json_path:
+        with open(json_path, "w") as fp:
+            json.dump(report, fp, indent = 2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+# Offline recall@k and size benchmark for shortened (Matryoshka) text-embedding-3 vectors.
+#
+#   python airflow/benchmarks/matryoshka_recall.py --index <document_id>-doc-index [--namespace <ns>] [--export-npy vectors.npy]
+#   python airflow/benchmarks/matryoshka_recall.py --npy vectors.npy
+#
+# The stored full 3072-dimension vectors are read from the Pinecone index. --export-npy saves what was fetched,
+# so later runs with other settings can read that file instead of fetching the index again. Asking the API for
+# `dimensions=d` is equivalent to keeping the first d values and re-normalizing, so every reduced setting
+# is simulated from the stored vectors without new embedding calls. Stored vectors are sampled as queries
+# (excluding themselves), and the exact top-k at full dimension is the ground truth for each reduced one.
+
+import os
+import sys
+import json
+import time
+import argparse
+
+import numpy as np
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+def load_vectors_from_index(index_name, namespace = ""):
+    import pinecone
+
+    index = pinecone.Pinecone(api_key = os.getenv("PINECONE_API_KEY")).Index(index_name)
+    vectors = []
+    for ids in index.list(namespace = namespace):
+        fetched = index.fetch(ids = list(ids), namespace = namespace).vectors
+        vectors.extend(fetched[vector_id].values for vector_id in ids if vector_id in fetched)
+    return np.asarray(vectors, dtype = np.float32)
+
+def truncate_and_normalize(vectors, dimension):
+    reduced = vectors[:, :dimension]
+    return reduced / np.maximum(np.linalg.norm(reduced, axis = 1, keepdims = True), 1e-12)
+
+def top_k(vectors, query_ix, k):
+    # Exact cosine search; vectors are unit length so the dot product is the cosine similarity
+    scores = vectors[query_ix] @ vectors.T
+    scores[np.arange(len(query_ix)), query_ix] = -np.inf
+    return np.argsort(-scores, axis = 1)[:, :k]
+
+def benchmark(vectors, dimensions, num_queries, k, seed = 1):
+    rng = np.random.default_rng(seed)
+    query_ix = rng.choice(len(vectors), size = min(num_queries, len(vectors)), replace = False)
+
+    full_dimension = vectors.shape[1]
+    full_vectors = truncate_and_normalize(vectors, full_dimension)
+    ground_truth = top_k(full_vectors, query_ix, k)
+
+    results = []
+    for dimension in sorted(set(dimensions + [full_dimension])):
+        reduced_vectors = truncate_and_normalize(vectors, dimension)
+
+        start_time = time.perf_counter()
+        neighbours = top_k(reduced_vectors, query_ix, k)
+        elapsed = time.perf_counter() - start_time
+
+        recall = np.mean([len(set(found) & set(expected)) / k for found, expected in zip(neighbours, ground_truth)])
+        results.append({
+            'dimension'         : dimension,
+            'recall_at_k'       : float(recall),
+            'vector_mb'         : len(vectors) * dimension * 4 / (1024 * 1024),
+            'size_ratio'        : dimension / full_dimension,
+            'query_ms'          : 1000 * elapsed / len(query_ix)
+        })
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description = "Compare recall@k and index size of shortened embeddings")
+    source = parser.add_mutually_exclusive_group(required = True)
+    source.add_argument("--index", help = "Pinecone index holding full-dimension vectors")
+    source.add_argument("--npy", help = "Full-dimension vectors saved by an earlier run with --export-npy")
+    parser.add_argument("--export-npy", help = "Save the vectors fetched from --index to this .npy file")
+    parser.add_argument("--namespace", default = "", help = "Namespace of the document in a shared index")
+    parser.add_argument("--dims", default = "256,512,1024", help = "Comma separated reduced dimensions")
+    parser.add_argument("--queries", type = int, default = 200, help = "Number of stored vectors used as queries")
+    parser.add_argument("-k", type = int, default = 5, help = "Recall cut-off")
+    parser.add_argument("--json", dest = "json_path", help = "Write the results to this JSON file")
+    args = parser.parse_args()
+
+    if args.npy:
+        vectors = np.load(args.npy).astype(np.float32)
+    else:
+        vectors = load_vectors_from_index(args.index, args.namespace)
+        if args.export_npy:
+            np.save(args.export_npy, vectors)
+            print(f"Saved {len(vectors)} vectors to {args.export_npy}")
+    if len(vectors) <= args.k:
+        sys.exit(f"Need more than {args.k} vectors, found {len(vectors)}")
+
+    results = benchmark(vectors, [int(dimension) for dimension in args.dims.split(",")], args.queries, args.k)
+
+    print(f"{len(vectors)} vectors, {min(args.queries, len(vectors))} queries")
+    print(f"{'dimension':>10}{f'recall@{args.k}':>12}{'vectors MB':>12}{'size':>8}{'query ms':>10}")
+    for result in results:
+        print(
+            f"{result['dimension']:>10}{result['recall_at_k']:>12.3f}{result['vector_mb']:>12.2f}"
+            f"{result['size_ratio']:>8.2f}{result['query_ms']:>10.3f}"
+        )
+
+    if args.json_path:
+        with open(args.json_path, "w") as fp:
+            json.dump(results, fp, indent = 2)
+
+if __name__ == "__main__":
+    main()
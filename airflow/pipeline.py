@@ -3,9 +3,29 @@
 # from airflow.utils.dates import days_ago
 
 import os
+import gc
+import re
+import fcntl
+import random
+import shutil
+import tempfile
+import struct
+import threading
+import unicodedata
+from collections import deque
+import numpy as np
+from contextlib import contextmanager
+import resource
+import hashlib
+import importlib.metadata
 import boto3
 import logging
+from botocore.config import Config
+from boto3.s3.transfer import TransferConfig
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 import pandas as pd
+import pypdfium2 as pdfium
 from pathlib import Path
 from dotenv import load_dotenv
 from docling.datamodel.base_models import InputFormat
@@ -16,7 +36,7 @@ from datetime import timedelta
 
 import os 
 import math
-import uuid
+import tiktoken
 import time
 import json
 import base64
@@ -29,13 +49,12 @@ from io import BytesIO
 from pathlib import Path
 from dotenv import load_dotenv
 from pinecone import ServerlessSpec
-from langchain_community.document_loaders import UnstructuredMarkdownLoader
+from pinecone.exceptions import PineconeApiException
+from unstructured.partition.md import partition_md
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_openai import OpenAIEmbeddings
 from langchain_openai import ChatOpenAI
-from langchain_pinecone import PineconeVectorStore
-from langchain_core.documents import Document
-from langchain.schema import HumanMessage
+from langchain.schema import HumanMessage, Document
 
 # Logger function
 logging.basicConfig(level = logging.INFO, format = '%(asctime)s - %(levelname)s - %(message)s')
@@ -44,80 +63,361 @@ logger = logging.getLogger(__name__)
 # Load Environment variables
 load_dotenv()
 
-def download_files_from_s3(bucket_name, document_id):
-    logger.info(f"Ariflow - download_files_from_s3 - Downloading files from s3 with respect to document_id {document_id}")
-    s3_client = boto3.client(
+# Name of the file that records the ETag and size of every object downloaded from S3
+S3_MANIFEST_FILENAME = ".s3_manifest.json"
+
+# Counters of the document stage running in this process, see _measure_stage. Stages run one at a time per
+# process (an Airflow task, or one step of main()), so every thread of the stage adds to the same dict
+_STAGE_METRICS = None
+_STAGE_METRICS_LOCK = threading.Lock()
+
+def _record_metrics(**counters):
+    # Outside a measured stage, e.g. in the driver functions, counters are dropped
+    with _STAGE_METRICS_LOCK:
+        if _STAGE_METRICS is None:
+            return
+        for name, value in counters.items():
+            _STAGE_METRICS[name] = _STAGE_METRICS.get(name, 0) + value
+
+def _create_s3_client(max_pool_connections = 10):
+    # A single client is shared by all download threads, so the connection pool has to be as large as the thread pool
+    return boto3.client(
         's3',
         aws_access_key_id = os.getenv("AWS_ACCESS_KEY_ID"),
-        aws_secret_access_key = os.getenv("AWS_SECRET_ACCESS_KEY")
+        aws_secret_access_key = os.getenv("AWS_SECRET_ACCESS_KEY"),
+        config = Config(max_pool_connections = max_pool_connections)
+    )
+
+def _list_s3_objects(s3_client, bucket_name, prefix):
+    # list_objects_v2 returns at most 1000 keys per call, so walk every page
+    s3_objects = []
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket = bucket_name, Prefix = prefix):
+        _record_metrics(s3_list_requests = 1)
+        s3_objects.extend(page.get('Contents', []))
+    return s3_objects
+
+def _load_s3_manifest(local_folder_path):
+    manifest_path = os.path.join(local_folder_path, S3_MANIFEST_FILENAME)
+    if not os.path.isfile(manifest_path):
+        return {}
+    try:
+        with open(manifest_path, "r") as fp:
+            return json.load(fp)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Ariflow - _load_s3_manifest - Ignoring unreadable manifest {manifest_path}: {e}")
+        return {}
+
+def _save_s3_manifest(local_folder_path, manifest):
+    # Per-document download tasks can run at the same time and share this manifest, so merge
+    # with what is on disk under a lock instead of overwriting another task's entries
+    manifest_path = os.path.join(local_folder_path, S3_MANIFEST_FILENAME)
+    with open(f"{manifest_path}.lock", "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            merged_manifest = _load_s3_manifest(local_folder_path)
+            merged_manifest.update(manifest)
+            tmp_path = f"{manifest_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as fp:
+                json.dump(merged_manifest, fp)
+            os.replace(tmp_path, manifest_path)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def _is_s3_object_current(s3_object, local_file_path, manifest):
+    # An object is current when the local copy has the same size and was downloaded from the same ETag
+    entry = manifest.get(s3_object['Key'])
+    return (
+        entry is not None
+        and entry.get('etag') == s3_object['ETag']
+        and entry.get('size') == s3_object['Size']
+        and os.path.isfile(local_file_path)
+        and os.path.getsize(local_file_path) == s3_object['Size']
+    )
+
+def _create_transfer_config():
+    # Transfers above the threshold are split into parts that move in parallel
+    return TransferConfig(
+        multipart_threshold = int(os.getenv("S3_MULTIPART_THRESHOLD_MB", 16)) * 1024 * 1024,
+        multipart_chunksize = int(os.getenv("S3_MULTIPART_CHUNKSIZE_MB", 16)) * 1024 * 1024,
+        max_concurrency     = int(os.getenv("S3_MULTIPART_CONCURRENCY", 4))
+    )
+
+def _download_s3_object(s3_client, bucket_name, s3_object, local_folder_path, transfer_config):
+    file_key = s3_object['Key']
+    local_file_path = os.path.join(local_folder_path, file_key)
+    os.makedirs(os.path.dirname(local_file_path), exist_ok=True)
+    s3_client.download_file(bucket_name, file_key, local_file_path, Config = transfer_config)
+    return s3_object['Size']
+
+def _download_s3_objects(s3_client, bucket_name, s3_objects, local_folder_path, max_workers):
+    manifest = _load_s3_manifest(local_folder_path)
+
+    # Objects above the threshold are fetched as parallel ranged GETs
+    transfer_config = _create_transfer_config()
+
+    pending_objects = []
+    skipped_objects = 0
+    for s3_object in s3_objects:
+        # Skip "folder" placeholder keys
+        if s3_object['Key'].endswith('/'):
+            continue
+        if _is_s3_object_current(s3_object, os.path.join(local_folder_path, s3_object['Key']), manifest):
+            skipped_objects += 1
+            continue
+        pending_objects.append(s3_object)
+
+    downloaded_bytes = 0
+    failed_keys = []
+    start_time = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers = max_workers) as executor:
+        futures = {
+            executor.submit(_download_s3_object, s3_client, bucket_name, s3_object, local_folder_path, transfer_config): s3_object
+            for s3_object in pending_objects
+        }
+        for future in as_completed(futures):
+            s3_object = futures[future]
+            try:
+                downloaded_bytes += future.result()
+                manifest[s3_object['Key']] = {'etag': s3_object['ETag'], 'size': s3_object['Size']}
+            except Exception as e:
+                logger.error(f"Ariflow - _download_s3_objects - Error downloading {s3_object['Key']}: {e}")
+                failed_keys.append(s3_object['Key'])
+
+    elapsed = max(time.perf_counter() - start_time, 1e-9)
+    downloaded_objects = len(pending_objects) - len(failed_keys)
+
+    # Record successful downloads even if some objects failed, so a retry only fetches what is missing
+    _save_s3_manifest(local_folder_path, manifest)
+
+    logger.info(
+        f"Ariflow - _download_s3_objects - Downloaded {downloaded_objects} objects ({downloaded_bytes / (1024 * 1024):.2f} MB) "
+        f"in {elapsed:.2f}s with {max_workers} workers - {downloaded_objects / elapsed:.2f} objects/s, "
+        f"{downloaded_bytes / (1024 * 1024) / elapsed:.2f} MB/s - skipped {skipped_objects} unchanged objects"
+    )
+
+    _record_metrics(
+        s3_get_requests             = len(pending_objects),
+        download_objects            = downloaded_objects,
+        download_bytes              = downloaded_bytes,
+        download_skipped_objects    = skipped_objects,
+        download_failed_objects     = len(failed_keys)
+    )
+
+    if failed_keys:
+        raise RuntimeError(f"Failed to download {len(failed_keys)} objects from s3: {failed_keys}")
+
+    return {
+        'objects'   : downloaded_objects,
+        'bytes'     : downloaded_bytes,
+        'skipped'   : skipped_objects,
+        'seconds'   : elapsed
+    }
+
+def _s3_etag_for_file(file_path, multipart_threshold, multipart_chunksize):
+    # ETag S3 assigns to an upload of this file: the MD5 of the body for single-part uploads, otherwise
+    # the MD5 of the concatenated part digests followed by the part count
+    part_digests = []
+    with open(file_path, "rb") as fp:
+        if os.path.getsize(file_path) < multipart_threshold:
+            return f'"{hashlib.md5(fp.read()).hexdigest()}"'
+        for part in iter(lambda: fp.read(multipart_chunksize), b""):
+            part_digests.append(hashlib.md5(part).digest())
+    return f'"{hashlib.md5(b"".join(part_digests)).hexdigest()}-{len(part_digests)}"'
+
+def _upload_s3_object(s3_client, bucket_name, local_file_path, file_key, transfer_config):
+    s3_client.upload_file(str(local_file_path), bucket_name, file_key, Config = transfer_config)
+    file_bytes = os.path.getsize(local_file_path)
+    _record_metrics(s3_put_requests = 1, upload_bytes = file_bytes)
+    return file_bytes
+
+def _upload_s3_objects(s3_client, bucket_name, files, prefixes, max_workers):
+    transfer_config = _create_transfer_config()
+
+    # One listing per prefix gives the ETags of everything already in the bucket
+    remote_etags = {}
+    for prefix in prefixes:
+        for s3_object in _list_s3_objects(s3_client, bucket_name, prefix):
+            remote_etags[s3_object['Key']] = s3_object['ETag']
+
+    pending_files = []
+    skipped_objects = 0
+    for local_file_path, file_key in files:
+        remote_etag = remote_etags.get(file_key)
+        if remote_etag and remote_etag == _s3_etag_for_file(local_file_path, transfer_config.multipart_threshold, transfer_config.multipart_chunksize):
+            skipped_objects += 1
+            continue
+        pending_files.append((local_file_path, file_key))
+
+    uploaded_bytes = 0
+    failed_keys = []
+    start_time = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers = max_workers) as executor:
+        futures = {
+            executor.submit(_upload_s3_object, s3_client, bucket_name, local_file_path, file_key, transfer_config): file_key
+            for local_file_path, file_key in pending_files
+        }
+        for future in as_completed(futures):
+            try:
+                uploaded_bytes += future.result()
+            except Exception as e:
+                logger.error(f"Ariflow - _upload_s3_objects - Error uploading {futures[future]}: {e}")
+                failed_keys.append(futures[future])
+
+    elapsed = max(time.perf_counter() - start_time, 1e-9)
+    uploaded_objects = len(pending_files) - len(failed_keys)
+    logger.info(
+        f"Ariflow - _upload_s3_objects - Uploaded {uploaded_objects} objects ({uploaded_bytes / (1024 * 1024):.2f} MB) "
+        f"in {elapsed:.2f}s with {max_workers} workers - {uploaded_objects / elapsed:.2f} objects/s, "
+        f"{uploaded_bytes / (1024 * 1024) / elapsed:.2f} MB/s - skipped {skipped_objects} unchanged objects"
     )
 
+    if failed_keys:
+        raise RuntimeError(f"Failed to upload {len(failed_keys)} objects to s3: {failed_keys}")
+
+    return {
+        'objects'   : uploaded_objects,
+        'bytes'     : uploaded_bytes,
+        'skipped'   : skipped_objects,
+        'seconds'   : elapsed
+    }
+
+def download_files_from_s3(bucket_name, document_id, s3_client = None, max_workers = None):
+    logger.info(f"Ariflow - download_files_from_s3 - Downloading files from s3 with respect to document_id {document_id}")
+    max_workers = max_workers or int(os.getenv("S3_DOWNLOAD_WORKERS", 16))
+    if s3_client is None:
+        s3_client = _create_s3_client(max_pool_connections = max_workers)
+
     local_folder_path = os.path.join(os.getcwd(), os.getenv("DOWNLOAD_DIRECTORY"))
     
     if not os.path.exists(local_folder_path):
         logger.info(f"Ariflow - download_files_from_s3 - Creating local directory to store files in {document_id}")
         os.makedirs(local_folder_path)
     else:
-        logger.info(f"Ariflow - download_files_from_s3 - Local directory for document {document_id} already exists, skipping download ")
+        logger.info(f"Ariflow - download_files_from_s3 - Local directory for document {document_id} already exists, skipping creation")
 
     try:
         # List all objects in the folder
-        files = s3_client.list_objects_v2(Bucket = bucket_name, Prefix = document_id)
-        if 'Contents' in files:
-            for file in files['Contents']:
-                file_key = file['Key']
-                local_file_path = os.path.join(local_folder_path, file_key)
-                os.makedirs(os.path.dirname(local_file_path), exist_ok=True)
-                s3_client.download_file(bucket_name, file_key, local_file_path)
+        # The artifact bundle is an output of the pipeline for readers of the bucket, not an input to parse
+        s3_objects = [
+            s3_object for s3_object in _list_s3_objects(s3_client, bucket_name, document_id)
+            if s3_object['Key'] != f"{document_id}/{ARTIFACT_BUNDLE_FILENAME}"
+        ]
+        if s3_objects:
+            stats = _download_s3_objects(s3_client, bucket_name, s3_objects, local_folder_path, max_workers)
             logger.info(f"Ariflow - download_files_from_s3 - Downloaded all files from {document_id} successfully to {local_folder_path}")
+            return stats
         else:
             logger.info(f"Ariflow - download_files_from_s3 - No files found in folder {document_id}")
-
+            return None
 
     except Exception as e:
         logger.error(f"Ariflow - download_files_from_s3 - Error downloading file {document_id}: {e}")
         raise e
 
+def discover_document_ids(bucket_name = None, s3_client = None):
+    logger.info(f"Ariflow - discover_document_ids - Discovering documents in s3")
+
+    # S3_DOCUMENT_IDS (comma separated) restricts a run to specific documents
+    document_ids = [document_id.strip().strip('/') for document_id in os.getenv("S3_DOCUMENT_IDS", "").split(",") if document_id.strip()]
+    if document_ids:
+        return document_ids
+
+    bucket_name = bucket_name or os.getenv("S3_BUCKET_NAME")
+    s3_client = s3_client or _create_s3_client()
+
+    # Every document lives under its own "<document_id>/" prefix
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket = bucket_name, Delimiter = '/'):
+        document_ids.extend(prefix['Prefix'].rstrip('/') for prefix in page.get('CommonPrefixes', []))
+
+    logger.info(f"Ariflow - discover_document_ids - Found {len(document_ids)} documents in {bucket_name}")
+    return document_ids
+
 def download_files_from_s3_driver_func():
     logger.info(f"Ariflow - download_files_from_s3_driver_func - Driver function to download files from s3")
     # Load environment variables
     bucket_name = os.getenv("S3_BUCKET_NAME")
-    document_ids = ['68db7e4f057f494fb5b939ba258cefcd/', '97b6383e18bb48d1b7daceb27ad0a198/', '52af53cc2f5e42558253aa572a55b78a/']
+    max_workers = int(os.getenv("S3_DOWNLOAD_WORKERS", 16))
+
+    local_folder_path = os.path.join(os.getcwd(), os.getenv("DOWNLOAD_DIRECTORY"))
+    os.makedirs(local_folder_path, exist_ok=True)
 
     try:
-        for document_id in document_ids:
-            download_files_from_s3(bucket_name, document_id)
+        # One client and one worker pool shared across all documents
+        s3_client = _create_s3_client(max_pool_connections = max_workers)
+        s3_objects = []
+        for document_id in discover_document_ids(bucket_name, s3_client):
+            document_objects = _list_s3_objects(s3_client, bucket_name, f"{document_id}/")
+            logger.info(f"Ariflow - download_files_from_s3_driver_func - Found {len(document_objects)} objects for {document_id}")
+            s3_objects.extend(document_objects)
+
+        _download_s3_objects(s3_client, bucket_name, s3_objects, local_folder_path, max_workers)
         logger.info(f"Ariflow - download_files_from_s3_driver_func - All files downloaded successfully from s3 to local")
     except Exception as e:
         logger.error(f"Ariflow - download_files_from_s3_driver_func - Error while downloading PDF documents from S3: {e}")
         raise e
 
 
-def document_Parser(input_doc_path, output_dir):
-    logger.info(f"Ariflow - document_Parser - Parsing through PDF file using Docling")
+def _get_images_scale():
+    # Scale at which page regions are rendered for the table and picture PNGs
+    return float(os.getenv("DOC_PARSER_IMAGES_SCALE", 5.0))
 
-    logger.info(f"Ariflow - document_Parser - Initializing parameters for pipeline_options")
+def _get_ocr_mode():
+    # "always" OCRs every page, "adaptive" only OCRs pages without a usable embedded text layer
+    return os.getenv("DOC_PARSER_OCR_MODE", "always").lower()
+
+def _build_pdf_pipeline_options(do_ocr = True):
+    logger.info(f"Ariflow - _build_pdf_pipeline_options - Initializing parameters for pipeline_options")
     # Parameters for pipeline
     pipeline_options = PdfPipelineOptions()
-    pipeline_options.do_ocr = True
+    pipeline_options.do_ocr = do_ocr
     pipeline_options.do_table_structure = True
     pipeline_options.table_structure_options.do_cell_matching = True
-    pipeline_options.images_scale = 5.0
+    pipeline_options.images_scale = _get_images_scale()
     pipeline_options.generate_table_images = True
     pipeline_options.generate_picture_images = True
 
-    logger.info(f"Ariflow - document_Parser - All parameters set for the pipeline options")
+    logger.info(f"Ariflow - _build_pdf_pipeline_options - All parameters set for the pipeline options")
+    return pipeline_options
+
+def _build_doc_converter(pipeline_options = None, do_ocr = True):
+    if pipeline_options is None:
+        pipeline_options = _build_pdf_pipeline_options(do_ocr)
+
     # Initializing document converter
     doc_converter = DocumentConverter(
         format_options = {
             InputFormat.PDF: PdfFormatOption(pipeline_options = pipeline_options)
         }
     )
-    logger.info(f"Ariflow - document_Parser - Document converter initialized")
+    # Docling only builds the PDF pipeline and loads its layout, OCR and table models on the first convert(); do it
+    # here so the first document parsed with this converter is not charged for model loading
+    doc_converter.initialize_pipeline(InputFormat.PDF)
+    logger.info(f"Ariflow - _build_doc_converter - Document converter initialized")
+    return doc_converter
+
+# Line written before each page's markdown. It renders as nothing, but lets chunking recover the pages a chunk spans
+PAGE_MARKER_FORMAT = "<!-- page {} -->"
+_PAGE_MARKER_PATTERN = re.compile(r"^<!-- page (\d+) -->$", re.MULTILINE)
+
+def document_Parser(input_doc_path, output_dir, doc_converter = None, page_range = None):
+    logger.info(f"Ariflow - document_Parser - Parsing through PDF file using Docling")
+
+    # Building the converter loads the layout, OCR and table models (see _build_doc_converter), so callers parsing
+    # many documents pass one in
+    if doc_converter is None:
+        doc_converter = _build_doc_converter()
 
     # Store the result
-    conv_result = doc_converter.convert(input_doc_path)
-    logger.info(f"Ariflow - document_Parser - All contents extracted from PDF file successfully")
+    if page_range:
+        conv_result = doc_converter.convert(input_doc_path, page_range = page_range)
+        logger.info(f"Ariflow - document_Parser - Contents of pages {page_range[0]}-{page_range[1]} extracted from PDF file successfully")
+    else:
+        conv_result = doc_converter.convert(input_doc_path)
+        logger.info(f"Ariflow - document_Parser - All contents extracted from PDF file successfully")
     
     # Store results in local directory
     doc_filename = conv_result.input.file.stem
@@ -159,19 +459,33 @@ def document_Parser(input_doc_path, output_dir):
 
     logger.info(f"Ariflow - document_Parser - All tables stored in CSV format in csv_files folder")
     
+    # Page numbers are those of the whole PDF even for a page_range shard, so merged shards keep correct markers
+    markdown_pages = []
+    for page_no in sorted(conv_result.document.pages):
+        page_markdown = conv_result.document.export_to_markdown(page_no = page_no)
+        if page_markdown.strip():
+            markdown_pages.append(f"{PAGE_MARKER_FORMAT.format(page_no)}\n\n{page_markdown}")
+
     with (Path(os.path.join(output_dir, f"{doc_filename}.md"))).open("w", encoding = "utf-8") as fp:
-        fp.write(conv_result.document.export_to_markdown())
+        fp.write("\n\n".join(markdown_pages))
 
     logger.info(f"Ariflow - document_Parser - Text from PDF document is stored as markdown file")
 
-def doc_parser_driver_func():
-    logger.info(f"Ariflow - doc_parser_driver_func - Driver function to parse through every PDF document using Docling")
-    download_dir = Path(os.path.join(os.getcwd(), os.getenv("DOWNLOAD_DIRECTORY")))
+    return {
+        'pages'     : len(conv_result.document.pages),
+        'tables'    : table_counter,
+        'images'    : image_counter
+    }
+
+def _find_documents_to_parse(download_dir, document_ids = None):
+    documents = []
 
     # Loop through all subdirectories (document_id folders) in the DOWNLOAD_DIRECTORY
-    logger.info(f"Ariflow - doc_parser_driver_func - Looping through all documents in {download_dir}")
+    logger.info(f"Ariflow - _find_documents_to_parse - Looping through all documents in {download_dir}")
     for document_id_dir in download_dir.iterdir():
-        logger.info(f"Ariflow - doc_parser_driver_func - Listing all PDF files in {document_id_dir}")
+        logger.info(f"Ariflow - _find_documents_to_parse - Listing all PDF files in {document_id_dir}")
+        if document_ids is not None and document_id_dir.name not in document_ids:
+            continue
         if document_id_dir.is_dir():
 
             # Initialize fname variable as None
@@ -189,12 +503,448 @@ def doc_parser_driver_func():
                 output_dir = Path(os.path.join(document_id_dir, "parsed_documents"))
                 output_dir.mkdir(parents=True, exist_ok=True)
                 input_dir = Path(os.path.join(document_id_dir, fname))
-                logger.info(f"Ariflow - doc_parser_driver_func - Parsing document from {input_dir} and storing the parsed_document in {output_dir}")
-                document_Parser(input_dir, output_dir)
+                documents.append((input_dir, output_dir))
             else:
-                logger.info(f"Ariflow - doc_parser_driver_func - No PDF file found in {document_id_dir}")
+                logger.info(f"Ariflow - _find_documents_to_parse - No PDF file found in {document_id_dir}")
         else:
-            logger.info(f"Ariflow - doc_parser_driver_func - {document_id_dir} directory does not exist")
+            logger.info(f"Ariflow - _find_documents_to_parse - {document_id_dir} directory does not exist")
+
+    return documents
+
+# Document converters of the current parse worker keyed by do_ocr, built once and reused for every document
+_WORKER_DOC_CONVERTERS = {}
+
+def _init_doc_parser_worker(num_threads = None):
+    # Split the cores between workers so the torch models in each process do not oversubscribe the CPU
+    if num_threads:
+        os.environ["OMP_NUM_THREADS"] = str(num_threads)
+        # OMP_NUM_THREADS is only read when torch loads, and a forked worker may have inherited it loaded already
+        import torch
+        torch.set_num_threads(num_threads)
+
+    _WORKER_DOC_CONVERTERS.clear()
+
+def _get_worker_doc_converter(do_ocr = True):
+    # The converter comes back with its pipeline initialized, so the models are loaded before any job timer starts
+    if do_ocr not in _WORKER_DOC_CONVERTERS:
+        _WORKER_DOC_CONVERTERS[do_ocr] = _build_doc_converter(do_ocr = do_ocr)
+    return _WORKER_DOC_CONVERTERS[do_ocr]
+
+# Name of the file that records which PDF and pipeline options produced a parsed_documents folder
+PARSE_MANIFEST_FILENAME = ".parse_manifest.json"
+
+def _hash_file(file_path, chunk_size = 1024 * 1024):
+    sha256 = hashlib.sha256()
+    with open(file_path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(chunk_size), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+def _parse_options_fingerprint():
+    # Any change to the pipeline options or to the Docling version invalidates previously parsed outputs
+    pipeline_options = _build_pdf_pipeline_options()
+    payload = {
+        'docling'   : importlib.metadata.version("docling"),
+        'options'   : pipeline_options.model_dump(mode = "json"),
+        'ocr_mode'  : _get_ocr_mode(),
+        'ocr_min_chars' : int(os.getenv("DOC_PARSER_OCR_MIN_CHARS", 32)),
+        'markdown'  : "page-markers"
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys = True, default = str).encode("utf-8")).hexdigest()
+
+def _load_parse_manifest(output_dir):
+    manifest_path = os.path.join(output_dir, PARSE_MANIFEST_FILENAME)
+    if not os.path.isfile(manifest_path):
+        return None
+    try:
+        with open(manifest_path, "r") as fp:
+            return json.load(fp)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Ariflow - _load_parse_manifest - Ignoring unreadable manifest {manifest_path}: {e}")
+        return None
+
+def _save_parse_manifest(output_dir, pdf_sha256, options_fingerprint):
+    outputs = sorted(
+        str(file_path.relative_to(output_dir))
+        for file_path in Path(output_dir).rglob("*")
+        if file_path.is_file() and file_path.name != PARSE_MANIFEST_FILENAME and ".shards" not in file_path.parts
+    )
+    manifest = {
+        'pdf_sha256'            : pdf_sha256,
+        'options_fingerprint'   : options_fingerprint,
+        'outputs'               : outputs
+    }
+    manifest_path = os.path.join(output_dir, PARSE_MANIFEST_FILENAME)
+    with open(f"{manifest_path}.tmp", "w") as fp:
+        json.dump(manifest, fp)
+    os.replace(f"{manifest_path}.tmp", manifest_path)
+
+def _is_parse_current(output_dir, pdf_sha256, options_fingerprint):
+    manifest = _load_parse_manifest(output_dir)
+    return (
+        manifest is not None
+        and manifest.get('pdf_sha256') == pdf_sha256
+        and manifest.get('options_fingerprint') == options_fingerprint
+        and all(os.path.isfile(os.path.join(output_dir, output)) for output in manifest.get('outputs', []))
+    )
+
+def _select_documents_to_parse(documents, options_fingerprint, force = False):
+    selected = []
+    pdf_hashes = {}
+
+    for input_doc_path, output_dir in documents:
+        pdf_sha256 = _hash_file(input_doc_path)
+        if not force and _is_parse_current(output_dir, pdf_sha256, options_fingerprint):
+            logger.info(f"Ariflow - _select_documents_to_parse - {input_doc_path} is unchanged since it was last parsed, skipping")
+            continue
+
+        # Start from an empty folder so artifacts of an older version of the PDF are not picked up downstream
+        shutil.rmtree(output_dir, ignore_errors=True)
+        Path(output_dir).mkdir(parents=True, exist_ok=True)
+
+        pdf_hashes[str(input_doc_path)] = pdf_sha256
+        selected.append((input_doc_path, output_dir))
+
+    return selected, pdf_hashes
+
+def _pdf_page_sizes(input_doc_path):
+    pdf = pdfium.PdfDocument(str(input_doc_path))
+    try:
+        return [pdf[page_ix].get_size() for page_ix in range(len(pdf))]
+    finally:
+        pdf.close()
+
+def _pages_needing_ocr(input_doc_path):
+    # A page needs OCR when its embedded text layer has (almost) no characters, i.e. it is scanned or image-only
+    min_chars = int(os.getenv("DOC_PARSER_OCR_MIN_CHARS", 32))
+    ocr_flags = []
+
+    pdf = pdfium.PdfDocument(str(input_doc_path))
+    try:
+        for page_ix in range(len(pdf)):
+            textpage = pdf[page_ix].get_textpage()
+            try:
+                text = textpage.get_text_range()
+            finally:
+                textpage.close()
+            ocr_flags.append(len("".join(text.split())) < min_chars)
+    finally:
+        pdf.close()
+
+    return ocr_flags
+
+def _pages_per_shard_for_memory(page_sizes, shard_memory_budget_mb):
+    # Docling keeps every page bitmap of a conversion at images_scale until the table and picture crops are
+    # taken, so a shard gets as many pages as their estimated bitmaps fit into the budget left after the
+    # models. This only sizes shards, it does not limit what a worker actually uses; _run_parse_jobs reports
+    # jobs whose peak RSS went over the budget
+    images_scale = _get_images_scale()
+    largest_page_bytes = max(width * height for width, height in page_sizes) * images_scale * images_scale * 4
+    available_bytes = (shard_memory_budget_mb - int(os.getenv("DOC_PARSER_BASE_MEMORY_MB", 1024))) * 1024 * 1024
+    return max(1, int(available_bytes // largest_page_bytes))
+
+def _plan_page_shards(ocr_flags, pages_per_shard):
+    # Docling page ranges are 1-based and inclusive; a shard never mixes pages with and without OCR
+    page_shards = []
+    for page_no, do_ocr in enumerate(ocr_flags, start = 1):
+        if page_shards and page_shards[-1][2] == do_ocr and (not pages_per_shard or page_no - page_shards[-1][0] < pages_per_shard):
+            page_shards[-1] = (page_shards[-1][0], page_no, do_ocr)
+        else:
+            page_shards.append((page_no, page_no, do_ocr))
+    return page_shards
+
+def _plan_parse_jobs(documents, pages_per_shard, shard_memory_budget_mb = None, ocr_mode = "always"):
+    jobs = []
+    sharded_documents = {}
+    ocr_plans = {}
+
+    for input_doc_path, output_dir in documents:
+        page_sizes = []
+        ocr_flags = None
+        shard_size = pages_per_shard
+        if pages_per_shard or shard_memory_budget_mb or ocr_mode == "adaptive":
+            try:
+                page_sizes = _pdf_page_sizes(input_doc_path)
+                if shard_memory_budget_mb and page_sizes:
+                    memory_shard_size = _pages_per_shard_for_memory(page_sizes, shard_memory_budget_mb)
+                    shard_size = min(shard_size, memory_shard_size) if shard_size else memory_shard_size
+                if ocr_mode == "adaptive":
+                    ocr_flags = _pages_needing_ocr(input_doc_path)
+            except Exception as e:
+                logger.warning(f"Ariflow - _plan_parse_jobs - Could not read pages of {input_doc_path}, parsing it unsharded with OCR: {e}")
+                page_sizes = []
+                ocr_flags = None
+
+        page_count = len(page_sizes)
+        if ocr_flags is not None:
+            ocr_plans[str(input_doc_path)] = {
+                'output_dir'    : output_dir,
+                'page_count'    : page_count,
+                'ocr_pages'     : [page_no for page_no, do_ocr in enumerate(ocr_flags, start = 1) if do_ocr]
+            }
+            logger.info(f"Ariflow - _plan_parse_jobs - {len(ocr_plans[str(input_doc_path)]['ocr_pages'])}/{page_count} pages of {input_doc_path} need OCR")
+
+        page_shards = _plan_page_shards(ocr_flags if ocr_flags is not None else [True] * page_count, shard_size)
+
+        if len(page_shards) > 1:
+            shards_root = output_dir / ".shards"
+            shutil.rmtree(shards_root, ignore_errors=True)
+
+            shard_dirs = []
+            for start_page, end_page, do_ocr in page_shards:
+                shard_dir = shards_root / f"pages-{start_page}-{end_page}"
+                shard_dir.mkdir(parents=True, exist_ok=True)
+                shard_dirs.append(shard_dir)
+                jobs.append((input_doc_path, shard_dir, (start_page, end_page), do_ocr))
+
+            sharded_documents[str(input_doc_path)] = (output_dir, shard_dirs)
+            logger.info(f"Ariflow - _plan_parse_jobs - Split {input_doc_path} ({page_count} pages) into {len(shard_dirs)} shards")
+        else:
+            jobs.append((input_doc_path, output_dir, None, page_shards[0][2] if page_shards else True))
+
+    return jobs, sharded_documents, ocr_plans
+
+def _seconds_per_page(results, do_ocr):
+    seconds = sum(result['seconds'] for result in results if result['do_ocr'] == do_ocr)
+    pages = sum(result['pages'] for result in results if result['do_ocr'] == do_ocr)
+    return seconds / pages if pages else None
+
+def _write_ocr_report(input_doc_path, ocr_plan, results):
+    # Seconds per page with and without OCR, measured on this document when it has both kinds of pages
+    # and on the whole run otherwise
+    document_results = [result for result in results if result['input'] == str(input_doc_path)]
+    ocr_rate = _seconds_per_page(document_results, True) or _seconds_per_page(results, True)
+    text_rate = _seconds_per_page(document_results, False) or _seconds_per_page(results, False)
+    skipped_pages = ocr_plan['page_count'] - len(ocr_plan['ocr_pages'])
+
+    report = {
+        'ocr_mode'                  : "adaptive",
+        'page_count'                : ocr_plan['page_count'],
+        'ocr_pages'                 : ocr_plan['ocr_pages'],
+        'text_layer_pages'          : skipped_pages,
+        'seconds'                   : sum(result['seconds'] for result in document_results),
+        'estimated_seconds_saved'   : (ocr_rate - text_rate) * skipped_pages if ocr_rate is not None and text_rate is not None else None
+    }
+    with open(os.path.join(ocr_plan['output_dir'], "ocr_report.json"), "w") as fp:
+        json.dump(report, fp, indent = 2)
+
+    logger.info(
+        f"Ariflow - _write_ocr_report - {input_doc_path}: OCR ran on {len(ocr_plan['ocr_pages'])}/{ocr_plan['page_count']} pages, "
+        f"estimated time saved {report['estimated_seconds_saved'] if report['estimated_seconds_saved'] is not None else 'unknown'}s"
+    )
+
+def _renumber_artifact(filename, offset):
+    # Artifacts are named like table-3.png, picture-12.png or table-3.csv
+    match = re.match(r"^(.*)-(\d+)(\.[^.]+)$", filename)
+    return f"{match.group(1)}-{int(match.group(2)) + offset}{match.group(3)}"
+
+def _artifact_number(path):
+    return int(re.match(r"^.*-(\d+)\.[^.]+$", path.name).group(1))
+
+def _merge_parsed_shards(shard_dirs, output_dir):
+    logger.info(f"Ariflow - _merge_parsed_shards - Merging {len(shard_dirs)} shards into {output_dir}")
+
+    # Docling lays out, OCRs and extracts tables page by page, so the shard outputs concatenated in page
+    # order are the unsharded output; only the table-N/picture-N numbering has to continue across shards
+    markdown_parts = []
+    markdown_fname = None
+    offsets = {"tables": 0, "images": 0, "csv_files": 0}
+
+    for shard_dir in shard_dirs:
+        for folder in offsets:
+            target_dir = Path(os.path.join(output_dir, folder))
+            target_dir.mkdir(parents=True, exist_ok=True)
+
+            shard_files = sorted(Path(os.path.join(shard_dir, folder)).glob("*-*.*"), key = _artifact_number)
+            for shard_file in shard_files:
+                os.replace(shard_file, os.path.join(target_dir, _renumber_artifact(shard_file.name, offsets[folder])))
+            offsets[folder] += len(shard_files)
+
+        for shard_markdown in Path(shard_dir).glob("*.md"):
+            markdown_fname = shard_markdown.name
+            markdown_text = shard_markdown.read_text(encoding = "utf-8")
+            if markdown_text:
+                markdown_parts.append(markdown_text)
+
+    if markdown_fname:
+        with (Path(os.path.join(output_dir, markdown_fname))).open("w", encoding = "utf-8") as fp:
+            fp.write("\n\n".join(markdown_parts))
+
+    shutil.rmtree(Path(shard_dirs[0]).parent, ignore_errors=True)
+    logger.info(f"Ariflow - _merge_parsed_shards - Merged {offsets['tables']} tables and {offsets['images']} pictures into {output_dir}")
+
+def _parse_document_worker(input_doc_path, output_dir, page_range = None, do_ocr = True):
+    start_time = time.perf_counter()
+    parse_metrics = {}
+    try:
+        logger.info(f"Ariflow - _parse_document_worker - Parsing document from {input_doc_path} and storing the parsed_document in {output_dir}")
+        # The first job of each OCR mode in a worker builds the converter and loads its models; keep that out of the
+        # per-page timings
+        doc_converter = _get_worker_doc_converter(do_ocr)
+        start_time = time.perf_counter()
+        parse_metrics = document_Parser(input_doc_path, output_dir, doc_converter = doc_converter, page_range = page_range)
+        error = None
+    except Exception as e:
+        # Failures are reported back to the driver instead of aborting the batch
+        logger.error(f"Ariflow - _parse_document_worker - Error parsing {input_doc_path}: {e}")
+        error = f"{type(e).__name__}: {e}"
+    finally:
+        gc.collect()
+
+    return {
+        'input'         : str(input_doc_path),
+        'page_range'    : page_range,
+        'do_ocr'        : do_ocr,
+        'error'         : error,
+        'seconds'       : time.perf_counter() - start_time,
+        'peak_rss_mb'   : resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'metrics'       : parse_metrics
+    }
+
+def _parse_job_error(job, error):
+    # Result of a job whose worker never reported back, in the shape _parse_document_worker returns
+    input_doc_path, output_dir, page_range, do_ocr = job
+    logger.error(f"Ariflow - _run_parse_jobs - Error parsing {input_doc_path} (pages {page_range or 'all'}): {error}")
+    return {
+        'input'         : str(input_doc_path),
+        'page_range'    : page_range,
+        'do_ocr'        : do_ocr,
+        'error'         : error,
+        'seconds'       : 0.0,
+        'peak_rss_mb'   : 0.0,
+        'metrics'       : {}
+    }
+
+def _run_isolated_parse_job(job, num_threads):
+    # A pool of its own, so a worker that dies is pinned on this job alone
+    with ProcessPoolExecutor(max_workers = 1, initializer = _init_doc_parser_worker, initargs = (num_threads,)) as executor:
+        try:
+            return executor.submit(_parse_document_worker, *job).result()
+        except BrokenProcessPool as e:
+            return _parse_job_error(job, f"Worker process died: {e}")
+        except Exception as e:
+            return _parse_job_error(job, f"{type(e).__name__}: {e}")
+
+def _run_parse_jobs(jobs, max_workers):
+    results = []
+    max_workers = max(1, min(max_workers, len(jobs)))
+
+    if max_workers == 1:
+        _init_doc_parser_worker()
+        for input_doc_path, output_dir, page_range, do_ocr in jobs:
+            result = _parse_document_worker(input_doc_path, output_dir, page_range, do_ocr)
+            logger.info(f"Ariflow - _run_parse_jobs - Finished {result['input']} (pages {result['page_range'] or 'all'}) in {result['seconds']:.1f}s, peak RSS {result['peak_rss_mb']:.0f} MB")
+            results.append(result)
+        return results
+
+    num_threads = max(1, (os.cpu_count() or 1) // max_workers)
+    logger.info(f"Ariflow - _run_parse_jobs - Running {len(jobs)} parse jobs with {max_workers} worker processes and {num_threads} threads each")
+    unfinished_jobs = []
+    with ProcessPoolExecutor(max_workers = max_workers, initializer = _init_doc_parser_worker, initargs = (num_threads,)) as executor:
+        futures = {executor.submit(_parse_document_worker, *job): job for job in jobs}
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except BrokenProcessPool:
+                # A worker died (segfault, OOM kill) and took the pool down; every job still in it fails the same way
+                unfinished_jobs.append(futures[future])
+                continue
+            except Exception as e:
+                results.append(_parse_job_error(futures[future], f"{type(e).__name__}: {e}"))
+                continue
+            logger.info(f"Ariflow - _run_parse_jobs - Finished {result['input']} (pages {result['page_range'] or 'all'}) in {result['seconds']:.1f}s, worker peak RSS {result['peak_rss_mb']:.0f} MB")
+            results.append(result)
+
+    # We cannot tell which job killed the pool, so the unfinished ones are retried in a fresh worker each; only
+    # the job that crashes again is marked as failed and the others still get parsed, merged and recorded
+    if unfinished_jobs:
+        logger.warning(f"Ariflow - _run_parse_jobs - A parse worker died, retrying {len(unfinished_jobs)} unfinished jobs in isolated workers")
+        with ThreadPoolExecutor(max_workers = min(max_workers, len(unfinished_jobs))) as executor:
+            for result in executor.map(lambda job: _run_isolated_parse_job(job, num_threads), unfinished_jobs):
+                if not result['error']:
+                    logger.info(f"Ariflow - _run_parse_jobs - Finished {result['input']} (pages {result['page_range'] or 'all'}) in {result['seconds']:.1f}s, worker peak RSS {result['peak_rss_mb']:.0f} MB")
+                results.append(result)
+
+    return results
+
+def doc_parser_driver_func(max_workers = None, pages_per_shard = None, force = None, shard_memory_budget_mb = None, document_ids = None):
+    logger.info(f"Ariflow - doc_parser_driver_func - Driver function to parse through every PDF document using Docling")
+    download_dir = Path(os.path.join(os.getcwd(), os.getenv("DOWNLOAD_DIRECTORY")))
+    max_workers = max_workers or int(os.getenv("DOC_PARSER_WORKERS", 1))
+    pages_per_shard = pages_per_shard or int(os.getenv("DOC_PARSER_PAGES_PER_SHARD", 0))
+    if force is None:
+        force = os.getenv("DOC_PARSER_FORCE", "false").lower() in ("1", "true", "yes")
+    shard_memory_budget_mb = shard_memory_budget_mb or int(os.getenv("DOC_PARSER_SHARD_MEMORY_BUDGET_MB", 0))
+
+    documents = _find_documents_to_parse(download_dir, document_ids)
+    found_documents = len(documents)
+
+    # Skip documents whose parsed_documents folder was produced from the same PDF bytes and pipeline options
+    options_fingerprint = _parse_options_fingerprint()
+    documents, pdf_hashes = _select_documents_to_parse(documents, options_fingerprint, force)
+    _record_metrics(parse_skipped_documents = found_documents - len(documents))
+    if not documents:
+        logger.info(f"Ariflow - doc_parser_driver_func - No new or changed documents to parse in {download_dir}")
+        return
+
+    # Large PDFs, and PDFs whose estimated page bitmaps would not fit into the shard memory budget,
+    # are split into page-range shards that are scheduled like independent documents
+    jobs, sharded_documents, ocr_plans = _plan_parse_jobs(documents, pages_per_shard, shard_memory_budget_mb, _get_ocr_mode())
+    results = _run_parse_jobs(jobs, max_workers)
+
+    # The budget is an estimate; say so when a worker went over it (peak_rss_mb is the worker's high-water mark
+    # up to that job), in which case DOC_PARSER_BASE_MEMORY_MB is likely too low
+    if shard_memory_budget_mb:
+        for result in results:
+            if result['peak_rss_mb'] > shard_memory_budget_mb:
+                logger.warning(
+                    f"Ariflow - doc_parser_driver_func - Worker that parsed {result['input']} (pages {result['page_range'] or 'all'}) peaked at "
+                    f"{result['peak_rss_mb']:.0f} MB, over the shard memory budget of {shard_memory_budget_mb} MB"
+                )
+
+    # Number of pages each job covered, needed to turn job durations into per-page OCR costs
+    for result in results:
+        if result['page_range']:
+            result['pages'] = result['page_range'][1] - result['page_range'][0] + 1
+        else:
+            result['pages'] = ocr_plans.get(result['input'], {}).get('page_count', 0)
+
+    # Worker processes cannot add to the counters of this process, so their results are merged here
+    for result in results:
+        _record_metrics(**{f"parsed_{name}": value for name, value in result['metrics'].items()})
+    _record_metrics(
+        parse_jobs              = len(results),
+        parse_failed_jobs       = sum(1 for result in results if result['error']),
+        parse_worker_seconds    = sum(result['seconds'] for result in results)
+    )
+
+    errors = {}
+    for result in results:
+        if result['error']:
+            errors.setdefault(result['input'], []).append(result['error'])
+
+    for input_doc_path, (output_dir, shard_dirs) in sharded_documents.items():
+        if input_doc_path in errors:
+            continue
+        try:
+            _merge_parsed_shards(shard_dirs, output_dir)
+        except Exception as e:
+            logger.error(f"Ariflow - doc_parser_driver_func - Error merging shards of {input_doc_path}: {e}")
+            errors[input_doc_path] = [f"{type(e).__name__}: {e}"]
+
+    for input_doc_path, ocr_plan in ocr_plans.items():
+        if input_doc_path not in errors:
+            _write_ocr_report(input_doc_path, ocr_plan, results)
+
+    for input_doc_path, output_dir in documents:
+        if str(input_doc_path) not in errors:
+            _save_parse_manifest(output_dir, pdf_hashes[str(input_doc_path)], options_fingerprint)
+
+    logger.info(f"Ariflow - doc_parser_driver_func - Parsed {len(documents) - len(errors)}/{len(documents)} documents")
+    if errors:
+        for input_doc_path, document_errors in errors.items():
+            logger.error(f"Ariflow - doc_parser_driver_func - Failed to parse {input_doc_path}: {'; '.join(document_errors)}")
+        raise RuntimeError(f"Failed to parse {len(errors)} of {len(documents)} documents")
 
 
 def encode_image_to_base64(image_path):
@@ -207,42 +957,446 @@ def encode_image_to_base64(image_path):
     except Exception as e:
         logger.error(f"Ariflow - encode_image_to_base64 - Error encoding image to base64: {e}")
         return None
-    
-def image_summarize(img_base64, prompt):
-    logger.info(f"Ariflow - image_summarize - Summarizing image with GPT")
+
+# PIL names of the formats the vision model accepts; the lowercased name is also the MIME subtype
+VISION_IMAGE_FORMATS = ("JPEG", "PNG", "WEBP")
+
+def _get_vision_image_settings():
+    # Images are resized so their longest edge is at most VISION_IMAGE_MAX_EDGE before they are sent to the model
+    image_format = os.getenv("VISION_IMAGE_FORMAT", "JPEG").upper()
+    if image_format == "JPG":
+        image_format = "JPEG"
+    # An unknown format would fail every image inside the summarizer, so it is rejected before any is encoded
+    if image_format not in VISION_IMAGE_FORMATS:
+        raise ValueError(f"Unsupported VISION_IMAGE_FORMAT '{os.getenv('VISION_IMAGE_FORMAT')}', expected one of {', '.join(VISION_IMAGE_FORMATS)}")
+
+    return (
+        int(os.getenv("VISION_IMAGE_MAX_EDGE", 2048)),
+        image_format,
+        int(os.getenv("VISION_IMAGE_QUALITY", 85))
+    )
+
+def prepare_image_for_vision(image_bytes):
+    logger.info(f"Ariflow - prepare_image_for_vision - Resizing and re-encoding image for the vision model")
+
+    max_edge, image_format, quality = _get_vision_image_settings()
+
+    with Image.open(BytesIO(image_bytes)) as image:
+        image.load()
+        if max(image.size) > max_edge:
+            image.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+
+        # JPEG has no alpha channel, so flatten transparent renders onto white
+        if image_format == "JPEG" and image.mode != "RGB":
+            background = Image.new("RGB", image.size, (255, 255, 255))
+            background.paste(image.convert("RGBA"), mask = image.convert("RGBA").split()[-1])
+            image = background
+
+        buffer = BytesIO()
+        if image_format == "PNG":
+            image.save(buffer, image_format, optimize = True)
+        else:
+            image.save(buffer, image_format, quality = quality, optimize = True)
+
+    prepared_bytes = buffer.getvalue()
+    logger.info(f"Ariflow - prepare_image_for_vision - Image reduced from {len(image_bytes) / 1024:.0f} KB to {len(prepared_bytes) / 1024:.0f} KB as {image_format}")
+    return base64.b64encode(prepared_bytes).decode('utf-8'), f"image/{image_format.lower()}"
+
+VISION_MODEL = "gpt-4o"
+
+# Vision chat model shared by every summarization thread, created on first use
+_VISION_CHAT_MODEL = None
+_VISION_CHAT_MODEL_LOCK = threading.Lock()
+
+# Output cap of a vision summary, and a flat input estimate for one prepared image (a 768x2048 image at high
+# detail costs 85 + 6 * 170 tokens); both count against the tokens-per-minute budget before the request is sent
+VISION_MAX_TOKENS = 1024
+VISION_IMAGE_TOKEN_ESTIMATE = 1105
+
+def _get_vision_chat_model():
+    global _VISION_CHAT_MODEL
+    with _VISION_CHAT_MODEL_LOCK:
+        if _VISION_CHAT_MODEL is None:
+            # Retries are handled by image_summarize so that 429s back off instead of failing fast
+            _VISION_CHAT_MODEL = ChatOpenAI(
+                model       = VISION_MODEL,
+                max_tokens  = VISION_MAX_TOKENS,
+                api_key     = os.getenv("OPEN_AI_API"),
+                max_retries = 0
+            )
+    return _VISION_CHAT_MODEL
+
+def _retry_after_seconds(error):
+    # Retry-After header of an OpenAI error response, None when the server did not send one
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
     try:
+        return float(response.headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+def _rate_limit_retry_delay(error, attempt):
+    # Honour the Retry-After header when OpenAI sends one, otherwise exponential backoff with full jitter
+    retry_after = _retry_after_seconds(error)
+
+    base_delay = float(os.getenv("OPENAI_RETRY_BASE_SECONDS", 1.0))
+    max_delay = float(os.getenv("OPENAI_RETRY_MAX_SECONDS", 60.0))
+    backoff = random.uniform(0, min(max_delay, base_delay * (2 ** attempt)))
+    return max(backoff, retry_after or 0)
+
+class OpenAIRateLimiter:
+    # Client-side limiter shared by every thread calling one kind of OpenAI model. A request waits for a
+    # concurrency slot and for room in two token buckets, requests and tokens per minute, that refill continuously
+    # up to one minute of budget. Concurrency follows AIMD: it is halved when a 429 comes back and grows by one
+    # after a full window of successful requests. The limiter lives in one process, so it is given this
+    # process's share of the organization budget, see _get_openai_rate_limiter
+
+    def __init__(self, name, requests_per_minute, tokens_per_minute, max_concurrency):
+        self.name = name
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_concurrency = max(1, max_concurrency)
+        self.concurrency = self.max_concurrency
+        self._condition = threading.Condition()
+        self._request_budget = float(requests_per_minute)
+        self._token_budget = float(tokens_per_minute)
+        self._refilled_at = time.monotonic()
+        self._paused_until = 0.0
+        self._decreased_at = 0.0
+        self._in_flight = 0
+        self._successes = 0
+        # (start time, tokens) of the requests started during the last minute
+        self._recent = deque()
+        self._stats = {
+            'requests'              : 0,
+            'tokens'                : 0,
+            'throttled_requests'    : 0,
+            'throttle_wait_seconds' : 0.0,
+            'rate_limited_requests' : 0
+        }
 
-        chat = ChatOpenAI(
-            model       = "gpt-4o", 
-            max_tokens  = 1024,
-            api_key     = os.getenv("OPEN_AI_API")
+    def _refill(self, now):
+        elapsed = now - self._refilled_at
+        self._refilled_at = now
+        self._request_budget = min(self.requests_per_minute, self._request_budget + elapsed * self.requests_per_minute / 60)
+        self._token_budget = min(self.tokens_per_minute, self._token_budget + elapsed * self.tokens_per_minute / 60)
+
+    def acquire(self, tokens = 1):
+        # A request larger than the whole bucket could never start, so it only waits for a full bucket
+        tokens = min(tokens, self.tokens_per_minute)
+        start_time = time.monotonic()
+        throttled = False
+
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                waits = []
+                if now < self._paused_until:
+                    waits.append(self._paused_until - now)
+                if self._request_budget < 1:
+                    waits.append((1 - self._request_budget) * 60 / self.requests_per_minute)
+                if self._token_budget < tokens:
+                    waits.append((tokens - self._token_budget) * 60 / self.tokens_per_minute)
+                if not waits and self._in_flight < self.concurrency:
+                    break
+                # Budgets refill with time, a concurrency slot frees up when release() notifies
+                throttled = True
+                self._condition.wait(timeout = max(waits) if waits else None)
+
+            self._request_budget -= 1
+            self._token_budget -= tokens
+            self._in_flight += 1
+            self._recent.append((now, tokens))
+            while self._recent[0][0] < now - 60:
+                self._recent.popleft()
+
+            wait_seconds = now - start_time
+            self._stats['requests'] += 1
+            self._stats['tokens'] += tokens
+            if throttled:
+                self._stats['throttled_requests'] += 1
+                self._stats['throttle_wait_seconds'] += wait_seconds
+
+        if throttled:
+            _record_metrics(openai_throttled_requests = 1, openai_throttle_wait_seconds = wait_seconds)
+        return now
+
+    def release(self, started_at, rate_limited = False, retry_after = None):
+        with self._condition:
+            self._in_flight -= 1
+            if rate_limited:
+                # Requests already in flight when the limit was lowered do not lower it again
+                if started_at >= self._decreased_at:
+                    self.concurrency = max(1, self.concurrency // 2)
+                    self._decreased_at = time.monotonic()
+                self._successes = 0
+                # The server's budget is spent whatever ours says, so nothing starts before Retry-After has passed
+                self._request_budget = min(self._request_budget, 0.0)
+                if retry_after:
+                    self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+                self._stats['rate_limited_requests'] += 1
+            else:
+                self._successes += 1
+                if self._successes >= self.concurrency and self.concurrency < self.max_concurrency:
+                    self.concurrency += 1
+                    self._successes = 0
+            self._condition.notify_all()
+
+        if rate_limited:
+            _record_metrics(openai_rate_limited_requests = 1)
+
+    @contextmanager
+    def limit(self, tokens = 1):
+        started_at = self.acquire(tokens)
+        rate_limited = False
+        retry_after = None
+        try:
+            yield
+        except openai.RateLimitError as e:
+            rate_limited = True
+            retry_after = _retry_after_seconds(e)
+            raise
+        finally:
+            self.release(started_at, rate_limited, retry_after)
+
+    def stats(self):
+        # Counters since the process started, plus the current limit and the throughput of the last minute
+        with self._condition:
+            now = time.monotonic()
+            while self._recent and self._recent[0][0] < now - 60:
+                self._recent.popleft()
+            return {
+                **self._stats,
+                'concurrency'           : self.concurrency,
+                'in_flight'             : self._in_flight,
+                'requests_last_minute'  : len(self._recent),
+                'tokens_last_minute'    : sum(tokens for _, tokens in self._recent),
+                'paused_seconds'        : max(0.0, self._paused_until - now)
+            }
+
+    def describe(self):
+        stats = self.stats()
+        return (
+            f"{self.name} limiter at concurrency {stats['concurrency']}/{self.max_concurrency}, "
+            f"{stats['requests_last_minute']} requests and {stats['tokens_last_minute']} tokens in the last minute, "
+            f"{stats['throttled_requests']} requests throttled for {stats['throttle_wait_seconds']:.1f}s, "
+            f"{stats['rate_limited_requests']} rate limited by OpenAI"
         )
 
-        msg = chat.invoke(
-            [
-                HumanMessage(
-                    content=[
-                        {
-                            "type": "text", 
-                            "text": prompt
-                        },
-                        {
-                            "type"      : "image_url",
-                            "image_url" : {"url": f"data:image/jpeg;base64,{img_base64}"},
-                        },
+# Organization budgets per minute, by default OpenAI's tier 1 limits for gpt-4o and text-embedding-3-large
+_OPENAI_RATE_LIMIT_DEFAULTS = {
+    'vision'    : (500, 30000),
+    'embedding' : (3000, 1000000)
+}
+# main() runs one document at a time in this process, so the process owns the whole budget
+OPENAI_MAX_ACTIVE_TASKS = 1
+_OPENAI_RATE_LIMITERS = {}
+_OPENAI_RATE_LIMITERS_LOCK = threading.Lock()
+
+def _get_openai_rate_limiter(kind):
+    # One limiter per kind of model, since OpenAI budgets are per model. *_MAX_REQUESTS_PER_MINUTE and
+    # *_MAX_TOKENS_PER_MINUTE are organization budgets (0 disables that bucket), split evenly between the
+    # processes that may call the model at the same time
+    with _OPENAI_RATE_LIMITERS_LOCK:
+        if kind not in _OPENAI_RATE_LIMITERS:
+            requests_per_minute, tokens_per_minute = _OPENAI_RATE_LIMIT_DEFAULTS[kind]
+            prefix = kind.upper()
+            _OPENAI_RATE_LIMITERS[kind] = OpenAIRateLimiter(
+                kind,
+                requests_per_minute = float(os.getenv(f"{prefix}_MAX_REQUESTS_PER_MINUTE", requests_per_minute)) / OPENAI_MAX_ACTIVE_TASKS or float("inf"),
+                tokens_per_minute   = float(os.getenv(f"{prefix}_MAX_TOKENS_PER_MINUTE", tokens_per_minute)) / OPENAI_MAX_ACTIVE_TASKS or float("inf"),
+                max_concurrency     = int(os.getenv(f"{prefix}_MAX_CONCURRENCY", 4))
+            )
+        return _OPENAI_RATE_LIMITERS[kind]
+
+def openai_rate_limiter_stats():
+    with _OPENAI_RATE_LIMITERS_LOCK:
+        rate_limiters = dict(_OPENAI_RATE_LIMITERS)
+    return {kind: rate_limiter.stats() for kind, rate_limiter in rate_limiters.items()}
+
+def image_summarize(img_base64, prompt, max_retries = None, mime_type = "image/jpeg"):
+    logger.info(f"Ariflow - image_summarize - Summarizing image with GPT")
+    max_retries = int(os.getenv("OPENAI_MAX_RETRIES", 6)) if max_retries is None else max_retries
+    chat = _get_vision_chat_model()
+    rate_limiter = _get_openai_rate_limiter("vision")
+    estimated_tokens = _count_tokens([prompt])[0] + VISION_IMAGE_TOKEN_ESTIMATE + VISION_MAX_TOKENS
+    attempt = 0
+
+    while True:
+        try:
+            with rate_limiter.limit(estimated_tokens):
+                _record_metrics(vision_api_calls = 1)
+                msg = chat.invoke(
+                    [
+                        HumanMessage(
+                            content=[
+                                {
+                                    "type": "text", 
+                                    "text": prompt
+                                },
+                                {
+                                    "type"      : "image_url",
+                                    "image_url" : {"url": f"data:{mime_type};base64,{img_base64}"},
+                                },
+                            ]
+                        )
                     ]
                 )
-            ]
-        )
-        logger.info(f"Ariflow - image_summarize - Summary generated successfully")
-        return msg.content
-    
-    except Exception as e:
+            logger.info(f"Ariflow - image_summarize - Summary generated successfully")
+            usage = getattr(msg, "usage_metadata", None) or {}
+            _record_metrics(vision_input_tokens = usage.get('input_tokens', 0), vision_output_tokens = usage.get('output_tokens', 0))
+            return msg.content
+
+        except openai.RateLimitError as e:
+            if attempt >= max_retries:
+                logger.error(f"Ariflow - image_summarize - Rate limited by GPT-4o after {attempt + 1} attempts: {e}")
+                _record_metrics(vision_failures = 1)
+                return None
+            delay = _rate_limit_retry_delay(e, attempt)
+            logger.warning(f"Ariflow - image_summarize - Rate limited by GPT-4o, retrying in {delay:.1f}s ({attempt + 1}/{max_retries})")
+            _record_metrics(vision_retries = 1, vision_retry_wait_seconds = delay)
+            time.sleep(delay)
+            attempt += 1
+
+        except Exception as e:
             logger.error(f"Ariflow - image_summarize - Error generating summary with GPT-4o: {e}")
+            _record_metrics(vision_failures = 1)
             return None
 
+# Hit/miss counters of the on-disk summary cache for the lifetime of the process
+_SUMMARY_CACHE_STATS = {'hits': 0, 'misses': 0}
+_SUMMARY_CACHE_STATS_LOCK = threading.Lock()
+
+def _get_summary_cache_dir():
+    return os.getenv("SUMMARY_CACHE_DIR", os.path.join(os.getcwd(), ".summary_cache"))
+
+def _summary_cache_key(image_bytes, prompt, model):
+    sha256 = hashlib.sha256()
+    # The preprocessing settings change what the model sees, so they are part of the key as well
+    image_settings = ":".join(str(setting) for setting in _get_vision_image_settings())
+    for part in (model.encode("utf-8"), prompt.encode("utf-8"), image_settings.encode("utf-8"), image_bytes):
+        # Length-prefix every part so different splits of the same bytes cannot collide
+        sha256.update(len(part).to_bytes(8, "big"))
+        sha256.update(part)
+    return sha256.hexdigest()
+
+def _summary_cache_path(cache_key):
+    return os.path.join(_get_summary_cache_dir(), cache_key[:2], f"{cache_key}.json")
+
+def _read_cached_summary(cache_key):
+    cache_path = _summary_cache_path(cache_key)
+    if not os.path.isfile(cache_path):
+        return None
+    try:
+        with open(cache_path, "r") as fp:
+            return json.load(fp)['summary']
+    except (OSError, ValueError, KeyError) as e:
+        logger.warning(f"Ariflow - _read_cached_summary - Ignoring unreadable cache entry {cache_path}: {e}")
+        return None
+
+def _write_cached_summary(cache_key, summary, model):
+    cache_path = _summary_cache_path(cache_key)
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    # Write to a private temp file first so concurrent writers never expose a partial entry
+    tmp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w") as fp:
+        json.dump({'summary': summary, 'model': model, 'created_at': time.time()}, fp)
+    os.replace(tmp_path, cache_path)
+
+def _summarize_image_file(folder_path, image_filename, prompt, document_id):
+    logger.info(f"Ariflow - _summarize_image_file - Processing image {image_filename} for document ID {document_id}")
+    image_path = os.path.join(folder_path, image_filename)
 
-def process_images_and_tables(folder_path, document_id):
+    try:
+        with open(image_path, "rb") as img_file:
+            image_bytes = img_file.read()
+    except OSError as e:
+        logger.error(f"Ariflow - _summarize_image_file - Error reading image {image_path}: {e}")
+        return False, None, None
+
+    # Identical image bytes with the same prompt and model always reuse the stored summary
+    cache_key = _summary_cache_key(image_bytes, prompt, VISION_MODEL)
+    cached_summary = _read_cached_summary(cache_key)
+    if cached_summary:
+        logger.info(f"Ariflow - _summarize_image_file - Using cached summary for {image_filename} for document ID {document_id}")
+        return True, cached_summary, "cache"
+
+    # Downscale and re-encode a copy for the model, the full-resolution file on disk stays untouched
+    try:
+        image_base64, mime_type = prepare_image_for_vision(image_bytes)
+    except Exception as e:
+        logger.error(f"Ariflow - _summarize_image_file - Error preparing image {image_path}: {e}")
+        return False, None, None
+
+    image_summary = image_summarize(image_base64, prompt, mime_type = mime_type)
+    logger.info(f"Ariflow - _summarize_image_file - Image {image_filename} summary: {image_summary} for document ID {document_id}")
+    if image_summary:
+        _write_cached_summary(cache_key, image_summary, VISION_MODEL)
+    return True, image_summary, "vision"
+
+
+def _get_table_summary_mode():
+    # "vision" summarizes every rendered table with the vision model; "structured" describes tables from
+    # their CSV export and only falls back to vision when the extraction is empty or unreliable
+    return os.getenv("TABLE_SUMMARY_MODE", "vision").lower()
+
+def _describe_table_csv(csv_path, table_name, max_rows = None):
+    max_rows = max_rows or int(os.getenv("TABLE_SUMMARY_SAMPLE_ROWS", 5))
+    max_empty_ratio = float(os.getenv("TABLE_SUMMARY_MAX_EMPTY_RATIO", 0.5))
+
+    try:
+        table_df = pd.read_csv(csv_path, index_col = 0)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Ariflow - _describe_table_csv - Could not read {csv_path}: {e}")
+        return None
+
+    # Reject extractions that would describe the table worse than a vision summary: no cells, a single
+    # column, no real header (docling falls back to positional column names) or mostly empty cells
+    if table_df.empty or table_df.shape[1] < 2:
+        return None
+    columns = [str(column).strip() for column in table_df.columns]
+    if sum(1 for column in columns if column.isdigit() or column.startswith("Unnamed:")) > len(columns) / 2:
+        return None
+    if table_df.isna().to_numpy().mean() > max_empty_ratio:
+        return None
+
+    column_descriptions = []
+    for column_name, column in zip(columns, table_df.columns):
+        values = table_df[column].dropna()
+        numeric_values = pd.to_numeric(values, errors = "coerce")
+        if len(values) and numeric_values.notna().all():
+            column_descriptions.append(f"{column_name} (numeric, {numeric_values.min():g} to {numeric_values.max():g})")
+        else:
+            column_descriptions.append(f"{column_name} (text)")
+
+    lines = [
+        f"Table {table_name} with {table_df.shape[0]} rows and {table_df.shape[1]} columns.",
+        f"Columns: {', '.join(column_descriptions)}.",
+        "Rows:"
+    ]
+    for _, row in table_df.head(max_rows).iterrows():
+        cells = [f"{column_name}: {str(value)[:100]}" for column_name, value in zip(columns, row) if pd.notna(value)]
+        lines.append(" | ".join(cells))
+    if table_df.shape[0] > max_rows:
+        lines.append(f"... {table_df.shape[0] - max_rows} more rows")
+
+    return "\n".join(lines)
+
+def _summarize_table_file(folder_path, image_filename, prompt, document_id, csv_folder_path):
+    # tables/table-N.png and csv_files/table-N.csv come from the same TableItem
+    table_name = os.path.splitext(image_filename)[0]
+    table_description = _describe_table_csv(os.path.join(csv_folder_path, f"{table_name}.csv"), table_name)
+    if table_description:
+        logger.info(f"Ariflow - _summarize_table_file - Described {image_filename} from its CSV export for document ID {document_id}")
+        _record_metrics(table_csv_descriptions = 1)
+        return True, table_description, "csv"
+
+    logger.info(f"Ariflow - _summarize_table_file - CSV export of {image_filename} is empty or unreliable, using the vision model")
+    return _summarize_image_file(folder_path, image_filename, prompt, document_id)
+
+def process_images_and_tables(folder_path, document_id, max_workers = None, csv_folder_path = None, journal = None):
     logger.info(f"Ariflow - process_images_and_tables - Generating summaries for images in {folder_path} for document ID {document_id}")
     try:
         summaries = []
@@ -253,48 +1407,82 @@ def process_images_and_tables(folder_path, document_id):
             "Give a concise summary of the image that is well optimized for retrieval via RAGs."
         )
 
-        for image_filename in os.listdir(folder_path):
-            image_path = os.path.join(folder_path, image_filename)
+        image_filenames = [
+            image_filename for image_filename in os.listdir(folder_path)
+            if os.path.isfile(os.path.join(folder_path, image_filename))
+        ]
 
-            if os.path.isfile(image_path):
-                logger.info(f"Ariflow - process_images_and_tables - Processing image {image_filename} for document ID {document_id}")
+        # Tables with a usable CSV export are described from it instead of sending the rendered image
+        if csv_folder_path:
+            summarize_file = lambda image_filename: _summarize_table_file(folder_path, image_filename, prompt, document_id, csv_folder_path)
+        else:
+            summarize_file = lambda image_filename: _summarize_image_file(folder_path, image_filename, prompt, document_id)
+
+        # Files summarized by an earlier attempt of this document reuse the summary from the journal
+        def resumable_summarize_file(image_filename):
+            journal_key = _journal_file_key(folder_path, image_filename)
+            journal_summary = journal.get("summarized", journal_key)
+            if journal_summary:
+                journal.skip("summarized")
+                return True, journal_summary, "journal"
+
+            image_result = summarize_file(image_filename)
+            if image_result[1]:
+                journal.record("summarized", {journal_key: image_result[1]})
+            return image_result
+
+        # Vision calls run on a bounded thread pool; executor.map keeps the results in directory order
+        max_workers = max_workers or int(os.getenv("VISION_MAX_CONCURRENCY", 4))
+        with ThreadPoolExecutor(max_workers = max_workers) as executor:
+            image_results = list(executor.map(resumable_summarize_file if journal is not None else summarize_file, image_filenames))
+
+        # The last element of each result says where the summary came from; only vision calls are cache misses
+        cache_hits = sum(1 for _, _, source in image_results if source == "cache")
+        cache_misses = sum(1 for _, _, source in image_results if source == "vision")
+        with _SUMMARY_CACHE_STATS_LOCK:
+            _SUMMARY_CACHE_STATS['hits'] += cache_hits
+            _SUMMARY_CACHE_STATS['misses'] += cache_misses
+            total_hits, total_misses = _SUMMARY_CACHE_STATS['hits'], _SUMMARY_CACHE_STATS['misses']
+        _record_metrics(summary_files = len(image_results), summary_cache_hits = cache_hits, summary_cache_misses = cache_misses)
+        logger.info(
+            f"Ariflow - process_images_and_tables - Summary cache for document ID {document_id}: {cache_hits} hits, {cache_misses} misses "
+            f"(process total: {total_hits} hits, {total_misses} misses)"
+        )
+        if cache_misses:
+            logger.info(f"Ariflow - process_images_and_tables - {_get_openai_rate_limiter('vision').describe()}")
 
-                # Encode image to base64
-                image_base64 = encode_image_to_base64(image_path)
-                if image_base64:
-                    image_summary = image_summarize(image_base64, prompt)
-                    logger.info(f"Ariflow - process_images_and_tables - Image {image_filename} summary: {image_summary} for document ID {document_id}")
-                
-                    if image_summary:
-                        summaries.append(image_summary)
-                        document_image_summaries.append({
-                            'document_id': document_id,
-                            'filename': image_filename,
-                            'summary': image_summary
-                        })
-                        summary_filename = os.path.splitext(image_filename)[0] + "_summary.txt"
-                        summary_filedir = Path(os.path.join(folder_path, "summaries"))
-                        summary_filedir.mkdir(parents=True, exist_ok=True)
-                        summary_filepath = os.path.join(summary_filedir, summary_filename)
-                        with open(summary_filepath, "w") as file:
-                            file.write(image_summary)
-                        logger.info(f"Ariflow - process_images_and_tables - Summary generated successfully for {image_filename} for document ID {document_id}")
-                    else:
-                        summaries.append(f"Failed to summarize image: {image_filename}")
-                        document_image_summaries.append({
-                            'document_id': document_id,
-                            'filename': image_filename,
-                            'summary': f"Failed to summarize image: {image_filename}"
-                        })
-                        logger.warning(f"Ariflow - process_images_and_tables - Failed to summarize image {image_filename} for document ID {document_id}")
+        for image_filename, (image_encoded, image_summary, _) in zip(image_filenames, image_results):
+            if image_encoded:
+                if image_summary:
+                    summaries.append(image_summary)
+                    document_image_summaries.append({
+                        'document_id': document_id,
+                        'filename': image_filename,
+                        'summary': image_summary
+                    })
+                    summary_filename = os.path.splitext(image_filename)[0] + "_summary.txt"
+                    summary_filedir = Path(os.path.join(folder_path, "summaries"))
+                    summary_filedir.mkdir(parents=True, exist_ok=True)
+                    summary_filepath = os.path.join(summary_filedir, summary_filename)
+                    with open(summary_filepath, "w") as file:
+                        file.write(image_summary)
+                    logger.info(f"Ariflow - process_images_and_tables - Summary generated successfully for {image_filename} for document ID {document_id}")
                 else:
-                    summaries.append(f"Failed to encode image: {image_filename}")
+                    summaries.append(f"Failed to summarize image: {image_filename}")
                     document_image_summaries.append({
-                            'document_id': document_id,
-                            'filename': image_filename,
-                            'summary': "Failed to encode image"
-                        })
-                    logger.warning(f"Ariflow - process_images_and_tables - Failed to encode image {image_filename} for document ID {document_id}")
+                        'document_id': document_id,
+                        'filename': image_filename,
+                        'summary': f"Failed to summarize image: {image_filename}"
+                    })
+                    logger.warning(f"Ariflow - process_images_and_tables - Failed to summarize image {image_filename} for document ID {document_id}")
+            else:
+                summaries.append(f"Failed to encode image: {image_filename}")
+                document_image_summaries.append({
+                        'document_id': document_id,
+                        'filename': image_filename,
+                        'summary': "Failed to encode image"
+                    })
+                logger.warning(f"Ariflow - process_images_and_tables - Failed to encode image {image_filename} for document ID {document_id}")
 
         logger.info(f"Ariflow - process_images_and_tables - Summaries generated successfully for images in {folder_path} for document ID {document_id}")
         return summaries, document_image_summaries
@@ -303,34 +1491,511 @@ def process_images_and_tables(folder_path, document_id):
         raise e
 
 
-def create_embeddings_in_batches(embedding_model, texts, batch_size = 5):
-    logger.info(f"Ariflow - create_embeddings_in_batches - Creating embeddings")
-    all_embeddings = []
-    total_batches = math.ceil(len(texts)/ batch_size)
+EMBEDDING_MODEL = "text-embedding-3-large"
+
+# OpenAI accepts at most 2048 inputs and 300k tokens per embeddings request
+EMBEDDING_API_MAX_BATCH_SIZE = 2048
+EMBEDDING_API_MAX_BATCH_TOKENS = 300000
+EMBEDDING_FULL_DIMENSION = 3072
+
+def _get_embedding_dimension():
+    # text-embedding-3 models can return shortened (Matryoshka) embeddings; EMBEDDING_DIMENSIONS such as
+    # 256, 512 or 1024 trades some recall for smaller indexes and cheaper queries. backend/retrieve.py reads
+    # the same variable so queries are embedded at the dimension of the index
+    dimension = int(os.getenv("EMBEDDING_DIMENSIONS", EMBEDDING_FULL_DIMENSION))
+    if not 0 < dimension <= EMBEDDING_FULL_DIMENSION:
+        raise ValueError(f"EMBEDDING_DIMENSIONS must be between 1 and {EMBEDDING_FULL_DIMENSION}, got {dimension}")
+    return dimension
+
+def _create_embedding_model():
+    # chunk_size matches the API limit so each packed batch is sent as a single request
+    # Retries are handled by _embed_texts_in_batches, so that 429s reach the rate limiter instead of being retried inside
+    dimension = _get_embedding_dimension()
+    return OpenAIEmbeddings(
+        model       = EMBEDDING_MODEL,
+        api_key     = os.getenv("OPENAI_API_KEY"),
+        chunk_size  = EMBEDDING_API_MAX_BATCH_SIZE,
+        dimensions  = dimension if dimension != EMBEDDING_FULL_DIMENSION else None,
+        max_retries = 0
+    )
 
-    for i in range(total_batches):
-        # Get the start and end indices for the current batch
-        batch_texts = texts[i * batch_size: (i+1) * batch_size]
-        
-        # Generate embeddings for the current branch
-        batch_embeddings = embedding_model.embed_documents(batch_texts)
+# Tokenizer of the embedding models, loaded on first use
+_TOKEN_ENCODING = None
+
+def _count_tokens(texts):
+    global _TOKEN_ENCODING
+    if _TOKEN_ENCODING is None:
+        _TOKEN_ENCODING = tiktoken.get_encoding("cl100k_base")
+    return [len(_TOKEN_ENCODING.encode(text, disallowed_special = ())) for text in texts]
+
+def _pack_embedding_batches(token_counts, max_batch_tokens, max_batch_size):
+    # Greedily fill each batch in input order until the next text would exceed the item or token limit
+    batches = []
+    batch = []
+    batch_tokens = 0
+    for text_ix, text_tokens in enumerate(token_counts):
+        if batch and (len(batch) >= max_batch_size or batch_tokens + text_tokens > max_batch_tokens):
+            batches.append(batch)
+            batch, batch_tokens = [], 0
+        batch.append(text_ix)
+        batch_tokens += text_tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+class EmbeddingStore:
+    # Persistent embedding cache: vectors are rows of a float32 file read through np.memmap, and index.log maps
+    # sha256(model, normalized text) to a row. The log is append-only: a header (magic, dimension, generation)
+    # followed by fixed-size records of key, row and last use time; a later record of a key only refreshes its
+    # last use for LRU eviction. Each process keeps its place in the log and only reads what was appended since.
+    # Compaction rewrites vectors and log together under a new generation. Readers hold a shared flock and
+    # writers an exclusive one, so a reader never maps the vectors of another generation than its index.
+
+    INDEX_MAGIC = b"EMBIDX01"
+    INDEX_HEADER = struct.Struct("<8sQQ")
+    INDEX_RECORD_FIELDS = [('key', 'V32'), ('row', '<u8'), ('last_used', '<f8')]
+    INDEX_RECORD_SIZE = 48
+
+    def __init__(self, store_dir, max_entries = 0):
+        self.store_dir = store_dir
+        self.max_entries = max_entries
+        self.vectors_path = os.path.join(store_dir, "vectors.f32")
+        self.index_path = os.path.join(store_dir, "index.log")
+        self.lock_path = os.path.join(store_dir, ".lock")
+        self._lock = threading.Lock()
+        self._touched = {}
+        os.makedirs(store_dir, exist_ok=True)
+        self._reset_index(None, None)
+        with self._file_lock(shared = True):
+            self._refresh_index()
+
+    @staticmethod
+    def key(model, text):
+        normalized_text = unicodedata.normalize("NFC", text).strip()
+        return hashlib.sha256(f"{model}\x00{normalized_text}".encode("utf-8")).hexdigest()
+
+    @contextmanager
+    def _file_lock(self, shared = False):
+        with open(self.lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _reset_index(self, dimension, generation):
+        # Entries map the raw 32-byte key to [row, last_used]
+        self._entries = {}
+        self._dimension = dimension
+        self._generation = generation
+        self._row_count = 0
+        self._index_records = 0
+        self._index_offset = self.INDEX_HEADER.size
+
+    def _refresh_index(self):
+        # Callers hold the file lock. Reads the records appended since the last call, or the whole log again
+        # when it was compacted into a new generation in the meantime
+        try:
+            with open(self.index_path, "rb") as fp:
+                magic, dimension, generation = self.INDEX_HEADER.unpack(fp.read(self.INDEX_HEADER.size))
+                if magic != self.INDEX_MAGIC:
+                    raise ValueError(f"bad magic {magic!r}")
+                if generation != self._generation:
+                    self._reset_index(dimension, generation)
+                fp.seek(self._index_offset)
+                data = fp.read()
+        except FileNotFoundError:
+            self._reset_index(None, None)
+            return
+        except (OSError, ValueError, struct.error) as e:
+            logger.warning(f"Ariflow - EmbeddingStore - Ignoring unreadable index {self.index_path}: {e}")
+            self._reset_index(None, None)
+            return
+
+        # A torn record at the end, left by a writer that died mid-append, is not read
+        data = data[:len(data) - len(data) % self.INDEX_RECORD_SIZE]
+        records = np.frombuffer(data, dtype = np.dtype(self.INDEX_RECORD_FIELDS))
+        key_bytes = records['key'].tobytes()
+        for record_ix, (row, last_used) in enumerate(zip(records['row'].tolist(), records['last_used'].tolist())):
+            self._entries[key_bytes[record_ix * 32:(record_ix + 1) * 32]] = [row, last_used]
+        if len(records):
+            self._row_count = max(self._row_count, int(records['row'].max()) + 1)
+        self._index_records += len(records)
+        self._index_offset += len(data)
+
+    def _start_index(self, dimension):
+        # A missing or unreadable log starts a new generation with an empty vector file
+        tmp_path = f"{self.index_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as fp:
+            fp.write(self.INDEX_HEADER.pack(self.INDEX_MAGIC, dimension, time.time_ns()))
+        open(self.vectors_path, "wb").close()
+        os.replace(tmp_path, self.index_path)
+        self._refresh_index()
+
+    def _drop_torn_writes(self):
+        # Remove what a writer that died mid-append left behind: a torn log record, and vector rows no record points at
+        if os.path.getsize(self.index_path) > self._index_offset:
+            with open(self.index_path, "r+b") as fp:
+                fp.truncate(self._index_offset)
+        expected_bytes = self._row_count * self._dimension * 4
+        if os.path.isfile(self.vectors_path) and os.path.getsize(self.vectors_path) > expected_bytes:
+            with open(self.vectors_path, "r+b") as fp:
+                fp.truncate(expected_bytes)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_many(self, keys):
+        # Refresh, map and read under the shared lock, so a compaction cannot replace the files in between
+        with self._lock, self._file_lock(shared = True):
+            self._refresh_index()
+            if not self._entries or not os.path.isfile(self.vectors_path):
+                return [None] * len(keys)
+
+            vectors = np.memmap(self.vectors_path, dtype = np.float32, mode = "r", shape = (self._row_count, self._dimension))
+            now = time.time()
+            results = []
+            for key in keys:
+                key_bytes = bytes.fromhex(key)
+                entry = self._entries.get(key_bytes)
+                if entry is None:
+                    results.append(None)
+                    continue
+                results.append(vectors[entry[0]].tolist())
+                self._touched[key_bytes] = now
+            del vectors
+            return results
+
+    def put_many(self, keys, embeddings):
+        with self._lock, self._file_lock():
+            # Pick up rows appended by other processes since we last looked, so no row number is handed out twice
+            self._refresh_index()
+            if self._generation is None:
+                if not embeddings:
+                    return
+                self._start_index(len(embeddings[0]))
+            else:
+                self._drop_torn_writes()
+
+            # Uses recorded by get_many are only logged here, with the next write
+            records = []
+            for key_bytes, last_used in self._touched.items():
+                entry = self._entries.get(key_bytes)
+                if entry is not None and last_used > entry[1]:
+                    records.append((key_bytes, entry[0], last_used))
+            self._touched = {}
+
+            new_rows = {}
+            now = time.time()
+            for key, embedding in zip(keys, embeddings):
+                key_bytes = bytes.fromhex(key)
+                if key_bytes in self._entries or key_bytes in new_rows:
+                    continue
+                records.append((key_bytes, self._row_count + len(new_rows), now))
+                new_rows[key_bytes] = embedding
+
+            # Vectors go first, so every logged row is on disk by the time a reader can see its record
+            if new_rows:
+                with open(self.vectors_path, "ab") as fp:
+                    np.asarray(list(new_rows.values()), dtype = np.float32).tofile(fp)
+            if records:
+                with open(self.index_path, "ab") as fp:
+                    np.array(records, dtype = np.dtype(self.INDEX_RECORD_FIELDS)).tofile(fp)
+            self._refresh_index()
+
+            # Evict down to max_entries, and keep the log from growing without bound through refreshed uses
+            if (self.max_entries and len(self._entries) > self.max_entries) or self._index_records > 2 * len(self._entries) + 10000:
+                self._compact(self.max_entries)
+
+    def compact(self, max_entries = None):
+        with self._lock, self._file_lock():
+            self._refresh_index()
+            if self._generation is not None:
+                self._compact(max_entries or self.max_entries)
+
+    def _compact(self, max_entries):
+        # Keep the most recently used entries and rewrite the vector file and the log without unreferenced rows
+        entries = sorted(self._entries.items(), key = lambda item: item[1][1], reverse = True)
+        if max_entries:
+            entries = entries[:max_entries]
+
+        vectors_tmp_path = f"{self.vectors_path}.{os.getpid()}.tmp"
+        index_tmp_path = f"{self.index_path}.{os.getpid()}.tmp"
+        with open(vectors_tmp_path, "wb") as fp:
+            if entries:
+                vectors = np.memmap(self.vectors_path, dtype = np.float32, mode = "r", shape = (self._row_count, self._dimension))
+                for key_bytes, (old_row, _) in entries:
+                    vectors[old_row].tofile(fp)
+                del vectors
+        with open(index_tmp_path, "wb") as fp:
+            fp.write(self.INDEX_HEADER.pack(self.INDEX_MAGIC, self._dimension, time.time_ns()))
+            records = [(key_bytes, row, last_used) for row, (key_bytes, (_, last_used)) in enumerate(entries)]
+            np.array(records, dtype = np.dtype(self.INDEX_RECORD_FIELDS)).tofile(fp)
+
+        # Both files are swapped under the exclusive lock; readers re-read the log when they see the new generation
+        previous_rows = self._row_count
+        os.replace(vectors_tmp_path, self.vectors_path)
+        os.replace(index_tmp_path, self.index_path)
+        self._refresh_index()
+        logger.info(f"Ariflow - EmbeddingStore - Compacted {self.store_dir} from {previous_rows} rows to {self._row_count}")
+
+# Stores opened by this process, reused so later calls only read what other processes appended since
+_EMBEDDING_STORES = {}
+_EMBEDDING_STORES_LOCK = threading.Lock()
+
+def _embedding_store_name(embedding_model):
+    # One store per model and output dimension, since their vectors are not interchangeable
+    model_name = getattr(embedding_model, "model", None) or EMBEDDING_MODEL
+    dimensions = getattr(embedding_model, "dimensions", None) or "default"
+    return f"{model_name}-{dimensions}"
+
+def _get_embedding_store(embedding_model):
+    if os.getenv("EMBEDDING_CACHE_ENABLED", "true").lower() not in ("1", "true", "yes"):
+        return None
+
+    store_dir = os.path.join(
+        os.getenv("EMBEDDING_CACHE_DIR", os.path.join(os.getcwd(), ".embedding_cache")),
+        _embedding_store_name(embedding_model)
+    )
+    with _EMBEDDING_STORES_LOCK:
+        if store_dir not in _EMBEDDING_STORES:
+            _EMBEDDING_STORES[store_dir] = EmbeddingStore(store_dir, max_entries = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", 0)))
+        return _EMBEDDING_STORES[store_dir]
 
-        # Append the embeddings to the list of all embeddings
-        all_embeddings.extend(batch_embeddings)
-        logger.info(f"Ariflow - create_embeddings_in_batches - Processed batch {i+1}/{total_batches} with {len(batch_texts)} texts.")
+def create_embeddings_in_batches(embedding_model, texts, max_batch_tokens = None, max_batch_size = None, max_workers = None, embedding_store = None, on_batch = None):
+    logger.info(f"Ariflow - create_embeddings_in_batches - Creating embeddings")
+    if embedding_store is None:
+        embedding_store = _get_embedding_store(embedding_model)
+
+    all_embeddings = [None] * len(texts)
+    missing_texts = list(texts)
+    missing_keys = []
+
+    # Serve what we can from the embedding store and only send unseen texts to the API, each one once
+    if embedding_store is not None:
+        model_name = getattr(embedding_model, "model", None) or EMBEDDING_MODEL
+        keys = [EmbeddingStore.key(model_name, text) for text in texts]
+        missing_positions = {}
+        for text_ix, (key, embedding) in enumerate(zip(keys, embedding_store.get_many(keys))):
+            if embedding is not None:
+                all_embeddings[text_ix] = embedding
+            else:
+                missing_positions.setdefault(key, []).append(text_ix)
+
+        missing_keys = list(missing_positions)
+        missing_texts = [texts[positions[0]] for positions in missing_positions.values()]
+        cache_hits = len(texts) - sum(len(positions) for positions in missing_positions.values())
+        _record_metrics(embedding_cache_hits = cache_hits, embedding_cache_misses = len(missing_texts))
+        logger.info(f"Ariflow - create_embeddings_in_batches - Embedding cache: {cache_hits} hits, {len(missing_texts)} misses")
+
+        # Each finished batch goes into the store right away, so a failure later in the run keeps it
+        def store_batch(batch, batch_embeddings):
+            embedding_store.put_many([missing_keys[missing_ix] for missing_ix in batch], batch_embeddings)
+            if on_batch is not None:
+                text_positions = [missing_positions[missing_keys[missing_ix]] for missing_ix in batch]
+                on_batch(
+                    [text_ix for positions in text_positions for text_ix in positions],
+                    [embedding for positions, embedding in zip(text_positions, batch_embeddings) for _ in positions]
+                )
 
+        if missing_texts:
+            missing_embeddings = _embed_texts_in_batches(embedding_model, missing_texts, max_batch_tokens, max_batch_size, max_workers, store_batch)
+            for key, embedding in zip(missing_keys, missing_embeddings):
+                for text_ix in missing_positions[key]:
+                    all_embeddings[text_ix] = embedding
+        return all_embeddings
+
+    return _embed_texts_in_batches(embedding_model, texts, max_batch_tokens, max_batch_size, max_workers, on_batch)
+
+def _embed_texts_in_batches(embedding_model, texts, max_batch_tokens = None, max_batch_size = None, max_workers = None, on_batch = None):
+    max_batch_tokens = min(max_batch_tokens or int(os.getenv("EMBEDDING_BATCH_MAX_TOKENS", 100000)), EMBEDDING_API_MAX_BATCH_TOKENS)
+    max_batch_size = min(max_batch_size or int(os.getenv("EMBEDDING_BATCH_MAX_SIZE", EMBEDDING_API_MAX_BATCH_SIZE)), EMBEDDING_API_MAX_BATCH_SIZE)
+    max_workers = max_workers or int(os.getenv("EMBEDDING_MAX_CONCURRENCY", 4))
+    max_retries = int(os.getenv("OPENAI_MAX_RETRIES", 6))
+    rate_limiter = _get_openai_rate_limiter("embedding")
+
+    token_counts = _count_tokens(texts)
+    batches = _pack_embedding_batches(token_counts, max_batch_tokens, max_batch_size)
+    total_batches = len(batches)
+    all_embeddings = [None] * len(texts)
+
+    def embed_batch(batch_number, batch):
+        batch_tokens = sum(token_counts[text_ix] for text_ix in batch)
+        start_time = time.perf_counter()
+        attempt = 0
+
+        # Generate embeddings for the current batch; every attempt waits for the shared rate limiter
+        while True:
+            try:
+                with rate_limiter.limit(batch_tokens):
+                    _record_metrics(embedding_api_calls = 1)
+                    batch_embeddings = embedding_model.embed_documents([texts[text_ix] for text_ix in batch])
+                break
+            except openai.RateLimitError as e:
+                if attempt >= max_retries:
+                    raise
+                delay = _rate_limit_retry_delay(e, attempt)
+                logger.warning(f"Ariflow - create_embeddings_in_batches - Batch {batch_number}/{total_batches} rate limited, retrying in {delay:.1f}s ({attempt + 1}/{max_retries})")
+                _record_metrics(embedding_retries = 1, embedding_retry_wait_seconds = delay)
+                time.sleep(delay)
+                attempt += 1
+        _record_metrics(embedding_texts = len(batch), embedding_tokens = batch_tokens)
+
+        elapsed = max(time.perf_counter() - start_time, 1e-9)
+        logger.info(
+            f"Ariflow - create_embeddings_in_batches - Processed batch {batch_number}/{total_batches} with {len(batch)} texts, "
+            f"{batch_tokens} tokens in {elapsed:.2f}s ({batch_tokens / elapsed:.0f} tokens/s)"
+        )
+        return batch, batch_embeddings
+
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers = max(1, min(max_workers, total_batches))) as executor:
+        futures = [executor.submit(embed_batch, batch_number, batch) for batch_number, batch in enumerate(batches, start = 1)]
+        for future in as_completed(futures):
+            batch, batch_embeddings = future.result()
+            # Put every vector back at the position of its text
+            for text_ix, embedding in zip(batch, batch_embeddings):
+                all_embeddings[text_ix] = embedding
+            if on_batch is not None:
+                on_batch(batch, batch_embeddings)
+
+    elapsed = max(time.perf_counter() - start_time, 1e-9)
+    logger.info(
+        f"Ariflow - create_embeddings_in_batches - Embedded {len(texts)} texts ({sum(token_counts)} tokens) in {total_batches} batches "
+        f"and {elapsed:.2f}s - {len(texts) / elapsed:.1f} texts/s, {sum(token_counts) / elapsed:.0f} tokens/s"
+    )
+    logger.info(f"Ariflow - create_embeddings_in_batches - {rate_limiter.describe()}")
     return all_embeddings
 
-def save_data_into_VectorDB(markdown_file_path, images_folder_path, tables_folder_path, document_id):
-    logger.info(f"Ariflow - save_data_into_VectorDB - Storing embeddings into vector database")
+def _upsert_vectors(index, vectors, max_batch_size = None, max_request_bytes = 2 * 1024 * 1024, namespace = "", on_batch = None):
+    # Pinecone limits upserts to 1000 vectors and 2 MB per request; 3072-dimension vectors
+    # serialized as JSON take roughly 12 bytes per value, so batches are cut by estimated size
+    max_batch_size = max_batch_size or int(os.getenv("PINECONE_UPSERT_BATCH_SIZE", 100))
+    batch = []
+    batch_bytes = 0
+    batches = 0
+
+    for vector in vectors:
+        vector_bytes = len(vector['values']) * 12 + len(json.dumps(vector['metadata'])) + len(vector['id']) + 64
+        if batch and (len(batch) >= max_batch_size or batch_bytes + vector_bytes > max_request_bytes * 0.9):
+            index.upsert(vectors = batch, namespace = namespace)
+            _record_metrics(pinecone_upsert_requests = 1, vectors_upserted = len(batch), upsert_bytes = batch_bytes)
+            batches += 1
+            if on_batch is not None:
+                on_batch([batch_vector['id'] for batch_vector in batch])
+            batch, batch_bytes = [], 0
+        batch.append(vector)
+        batch_bytes += vector_bytes
+
+    if batch:
+        index.upsert(vectors = batch, namespace = namespace)
+        _record_metrics(pinecone_upsert_requests = 1, vectors_upserted = len(batch), upsert_bytes = batch_bytes)
+        batches += 1
+        if on_batch is not None:
+            on_batch([batch_vector['id'] for batch_vector in batch])
+
+    logger.info(f"Ariflow - _upsert_vectors - Upserted {len(vectors)} vectors in {batches} batches")
+
+def _delete_vectors(index, ids, batch_size = 1000, namespace = ""):
+    # Pinecone deletes at most 1000 IDs per request
+    for start in range(0, len(ids), batch_size):
+        index.delete(ids = ids[start:start + batch_size], namespace = namespace)
+        _record_metrics(pinecone_delete_requests = 1, vectors_deleted = len(ids[start:start + batch_size]))
+    logger.info(f"Ariflow - _delete_vectors - Deleted {len(ids)} vectors")
+
+def _chunk_id(document_id, text):
+    # Content-derived ID, so the same chunk maps onto the same vector on every ingest
+    normalized_text = unicodedata.normalize("NFC", text).strip()
+    return f"{document_id}#{hashlib.sha256(normalized_text.encode('utf-8')).hexdigest()[:32]}"
+
+def _list_vector_ids(index, prefix = None, namespace = ""):
+    # index.list pages through the IDs stored in a serverless index
+    for ids in index.list(prefix = prefix, namespace = namespace):
+        _record_metrics(pinecone_list_requests = 1)
+        yield from ids
+
+def _get_pinecone_target(document_id):
+    # "per_document" keeps one index per document; "shared" stores every document in one index under
+    # a namespace named after its document_id, so adding a document needs no index provisioning
+    index_mode = os.getenv("PINECONE_INDEX_MODE", "per_document").lower()
+    if index_mode == "shared":
+        return os.getenv("PINECONE_SHARED_INDEX_NAME", "documents-index"), document_id
+    if index_mode != "per_document":
+        raise ValueError(f"Unsupported PINECONE_INDEX_MODE '{index_mode}', expected 'per_document' or 'shared'")
+    return f'{document_id}-doc-index', ""
+
+def _ensure_index(pc, index_name, dimension, recreate_on_mismatch = True):
+    # Reuse the index when it exists so retrieval keeps serving during a re-ingest; it is only
+    # recreated when its dimension no longer matches the embeddings. Returns the index and whether it was
+    # created by this call, in which case it holds none of the vectors an earlier attempt upserted
+    if index_name in pc.list_indexes().names():
+        existing_dimension = pc.describe_index(index_name).dimension
+        if existing_dimension == dimension:
+            logger.info(f"Ariflow - _ensure_index - Using existing index {index_name}")
+            return pc.Index(index_name), False
+        if not recreate_on_mismatch:
+            raise ValueError(f"Index {index_name} has dimension {existing_dimension} but EMBEDDING_DIMENSIONS is {dimension}")
+        logger.warning(f"Ariflow - _ensure_index - Index {index_name} has dimension {existing_dimension}, expected {dimension}; recreating it")
+        pc.delete_index(index_name)
 
-    # Load data from markdown file using Unstructured
-    logger.info(f"Ariflow - save_data_into_VectorDB - Load data from markdown file using Unstructured")
-    loader = UnstructuredMarkdownLoader(markdown_file_path, mode="elements")
-    data = loader.load()
+    # Create a spec for the index
+    spec = ServerlessSpec(cloud="aws", region="us-east-1")
 
+    try:
+        pc.create_index(
+            name=index_name,
+            dimension=dimension,
+            metric='cosine',
+            spec=spec
+        )
+        logger.info(f"Ariflow - _ensure_index - Created new index {index_name}")
+    except PineconeApiException as e:
+        # Mapped embed tasks of a first run all find the shared index missing and race to create it; the
+        # losers get 409 Conflict and wait for the winner's index like it was their own
+        if getattr(e, "status", None) != 409:
+            raise
+        existing_dimension = pc.describe_index(index_name).dimension
+        if existing_dimension != dimension:
+            raise ValueError(f"Index {index_name} has dimension {existing_dimension} but EMBEDDING_DIMENSIONS is {dimension}")
+        logger.info(f"Ariflow - _ensure_index - Index {index_name} was created concurrently by another task")
+
+    # Wait for index to be initialized
+    while not pc.describe_index(index_name).status['ready']:
+        time.sleep(1)
+
+    return pc.Index(index_name), True
+
+def _create_pinecone_client():
+    return pinecone.Pinecone(api_key=os.getenv("PINECONE_API_KEY"))
+
+def _load_markdown_elements(markdown_file_path):
+    # Load data from markdown file using Unstructured
+    logger.info(f"Ariflow - _load_markdown_elements - Load data from markdown file using Unstructured")
+    markdown_text = Path(markdown_file_path).read_text(encoding = "utf-8")
+
+    # Splitting on the page markers gives [text before the first marker, page, text, page, text, ...]; markdown
+    # parsed before the markers existed is a single segment without a page
+    parts = _PAGE_MARKER_PATTERN.split(markdown_text)
+    segments = [(None, parts[0])] + [(int(parts[i]), parts[i + 1]) for i in range(1, len(parts), 2)]
+
+    elements = []
+    for page_number, segment_text in segments:
+        if not segment_text.strip():
+            continue
+        # Same documents UnstructuredMarkdownLoader builds in "elements" mode, plus the page they came from
+        for element in partition_md(text = segment_text):
+            metadata = {'source': str(markdown_file_path)}
+            metadata.update(element.metadata.to_dict())
+            metadata['category'] = element.category
+            if page_number is not None:
+                metadata['page_number'] = page_number
+            elements.append(Document(page_content = str(element), metadata = metadata))
+
+    return elements
+
+def _split_elements(elements):
     # Text splitter for splitting data into chunks
-    logger.info(f"Ariflow - save_data_into_VectorDB - Creating textsplitter for splitting data into chunks")
+    logger.info(f"Ariflow - _split_elements - Creating textsplitter for splitting data into chunks")
     text_splitter = RecursiveCharacterTextSplitter(
         chunk_size=4000,
         chunk_overlap=200
@@ -338,83 +2003,764 @@ def save_data_into_VectorDB(markdown_file_path, images_folder_path, tables_folde
 
     chunks = []
     # Process markdown text
-    logger.info(f"Ariflow - save_data_into_VectorDB - Processing markdown text")
-    for element in data:
+    logger.info(f"Ariflow - _split_elements - Processing markdown text")
+    for element in elements:
         text = element.page_content
         chunks.extend(text_splitter.create_documents([text]))
-    
-    # Generate summaries for images and tables
-    # image_summaries, images_dict = process_images_and_tables(images_folder_path, document_id)
-    table_summaries, tables_dict = process_images_and_tables(tables_folder_path, document_id)
-    logger.info(f"Ariflow - save_data_into_VectorDB - Generated summaries for images and tables")
 
-    # Prepare text data for embedding (extract the actual text from chunks)
-    logger.info(f"Ariflow - save_data_into_VectorDB - Preparing text for embeddings")
-    texts = [chunk.page_content for chunk in chunks] + table_summaries
-    document_dict = tables_dict
+    return [(chunk.page_content, {}) for chunk in chunks]
 
-    # texts = [chunk.page_content for chunk in chunks] + image_summaries + table_summaries
-    # document_dict = images_dict + tables_dict
+def _pack_elements(elements, max_tokens = None, overlap_tokens = None):
+    max_tokens = max_tokens or int(os.getenv("CHUNK_MAX_TOKENS", 800))
+    overlap_tokens = overlap_tokens if overlap_tokens is not None else int(os.getenv("CHUNK_OVERLAP_TOKENS", 100))
 
-    embedding_model = OpenAIEmbeddings(model="text-embedding-3-large", api_key=os.getenv("OPENAI_API_KEY"))
+    # Only elements that exceed the budget on their own are cut, on token boundaries
+    oversize_splitter = RecursiveCharacterTextSplitter.from_tiktoken_encoder(
+        encoding_name = "cl100k_base",
+        chunk_size = max_tokens,
+        chunk_overlap = overlap_tokens
+    )
 
-    embeddings = create_embeddings_in_batches(embedding_model, texts)
+    token_counts = _count_tokens([element.page_content for element in elements])
+    chunks = []
+    headings = []
+    parts = []
+    pages = []
+    chunk_tokens = 0
+    has_body = False
+
+    def chunk_metadata():
+        # Pinecone rejects null metadata values, so absent fields are left out
+        metadata = {
+            'headings'      : list(headings),
+            'section'       : headings[-1] if headings else None,
+            'page_start'    : min(pages) if pages else None,
+            'page_end'      : max(pages) if pages else None
+        }
+        return {key: value for key, value in metadata.items() if value not in (None, [])}
+
+    def flush():
+        nonlocal chunk_tokens, has_body
+        if parts:
+            chunks.append(("\n\n".join(parts), chunk_metadata()))
+        parts.clear()
+        pages.clear()
+        chunk_tokens = 0
+        has_body = False
+
+    for element, element_tokens in zip(elements, token_counts):
+        text = element.page_content.strip()
+        if not text:
+            continue
+        page_number = element.metadata.get("page_number")
+
+        # A heading closes the current chunk, unless the chunk holds nothing but headings so far
+        if element.metadata.get("category") == "Title":
+            if has_body:
+                flush()
+            depth = element.metadata.get("category_depth") or 0
+            headings[depth:] = [text]
+        elif element_tokens > max_tokens:
+            if has_body:
+                flush()
+            # Pending headings lead into the first piece instead of becoming a chunk of their own
+            pieces = oversize_splitter.split_text(text)
+            pieces[0] = "\n\n".join(parts + [pieces[0]])
+            if page_number is not None:
+                pages.append(page_number)
+            chunks.extend((piece, chunk_metadata()) for piece in pieces)
+            parts.clear()
+            flush()
+            continue
+        elif chunk_tokens + element_tokens > max_tokens:
+            flush()
+
+        parts.append(text)
+        if page_number is not None:
+            pages.append(page_number)
+        chunk_tokens += element_tokens
+        has_body = has_body or element.metadata.get("category") != "Title"
+
+    flush()
+    return chunks
+
+def _load_markdown_chunks(markdown_file_path, chunking_mode = None):
+    # "element" splits every Unstructured element on its own; "packed" packs consecutive elements of a
+    # section up to CHUNK_MAX_TOKENS and keeps heading and page metadata with each chunk
+    chunking_mode = (chunking_mode or os.getenv("CHUNKING_MODE", "element")).lower()
+    elements = _load_markdown_elements(markdown_file_path)
+
+    if chunking_mode == "packed":
+        chunks = _pack_elements(elements)
+    elif chunking_mode == "element":
+        chunks = _split_elements(elements)
+    else:
+        raise ValueError(f"Unsupported CHUNKING_MODE '{chunking_mode}', expected 'element' or 'packed'")
 
-    # Print the length of embeddings and the size of the first embedding vector
-    logger.info(f"Ariflow - save_data_into_VectorDB - Total embeddings generated: {len(embeddings)}")
-    logger.info(f"Ariflow - save_data_into_VectorDB - Size of first embedding: {len(embeddings[0])}")
+    logger.info(f"Ariflow - _load_markdown_chunks - {len(elements)} elements became {len(chunks)} chunks in {chunking_mode} mode")
+    return [text for text, _ in chunks], [metadata for _, metadata in chunks]
 
-    # Initialize Pinecone client
-    logger.info(f"Ariflow - save_data_into_VectorDB - Pinecone client created")
-    pc = pinecone.Pinecone(api_key=os.getenv("PINECONE_API_KEY"))
+def _get_table_csv_folder(tables_folder_path):
+    if tables_folder_path is None or _get_table_summary_mode() != "structured":
+        return None
+    return Path(tables_folder_path).parent / "csv_files"
 
-    # Pinecone index name
-    index_name = f'{document_id}-doc-index'
-    logger.info(f"Ariflow - save_data_into_VectorDB - Pinecone index created {index_name}")
+def summarize_document(images_folder_path, tables_folder_path, document_id, journal = None):
+    # Generate summaries for images and tables
+    # image_summaries, images_dict = process_images_and_tables(images_folder_path, document_id)
+    table_summaries, tables_dict = process_images_and_tables(tables_folder_path, document_id, csv_folder_path = _get_table_csv_folder(tables_folder_path), journal = journal)
+    logger.info(f"Ariflow - summarize_document - Generated summaries for images and tables")
 
-    # Check if the index exists, delete if present, then create a new one
-    if index_name in pc.list_indexes().names():
-        pc.delete_index(index_name)
-        logger.info(f"Ariflow - save_data_into_VectorDB - Deleting existing index {index_name}")
+    # texts = image_summaries + table_summaries
+    # document_dict = images_dict + tables_dict
+    return table_summaries, tables_dict
+
+# Near-duplicate chunk detection: MinHash signatures over word shingles, bucketed with LSH banding so each
+# chunk is only compared against chunks sharing a band, then confirmed with the exact Jaccard similarity
+_MINHASH_PRIME = (1 << 31) - 1
+
+def _chunk_shingles(text, shingle_size):
+    words = re.findall(r"\w+", unicodedata.normalize("NFC", text).lower())
+    if not words:
+        return set()
+    return {" ".join(words[i:i + shingle_size]) for i in range(max(1, len(words) - shingle_size + 1))}
+
+def _minhash_signature(shingles, num_perm):
+    hashes = np.array([
+        int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size = 4).digest(), "little") % _MINHASH_PRIME
+        for shingle in shingles
+    ], dtype = np.uint64)
+
+    # Fixed seed so the same chunk always gets the same signature; a, b and hashes are below 2^31, so no uint64 overflow
+    rng = np.random.RandomState(1)
+    a = rng.randint(1, _MINHASH_PRIME, num_perm).astype(np.uint64)
+    b = rng.randint(0, _MINHASH_PRIME, num_perm).astype(np.uint64)
+    return ((a[:, None] * hashes[None, :] + b[:, None]) % _MINHASH_PRIME).min(axis = 1)
+
+def deduplicate_chunks(texts, threshold = None, num_perm = None, bands = None, shingle_size = None):
+    threshold = threshold or float(os.getenv("CHUNK_DEDUP_THRESHOLD", 0.9))
+    num_perm = num_perm or int(os.getenv("CHUNK_DEDUP_NUM_PERM", 128))
+    bands = bands or int(os.getenv("CHUNK_DEDUP_BANDS", 16))
+    shingle_size = shingle_size or int(os.getenv("CHUNK_DEDUP_SHINGLE_SIZE", 5))
+    rows = num_perm // bands
+
+    kept_positions = []
+    kept_shingles = []
+    dropped_positions = []
+    buckets = {}
+
+    # The first occurrence in document order is kept, later near-duplicates are dropped
+    for text_ix, text in enumerate(texts):
+        shingles = _chunk_shingles(text, shingle_size)
+        if not shingles:
+            kept_positions.append(text_ix)
+            kept_shingles.append(shingles)
+            continue
+
+        signature = _minhash_signature(shingles, num_perm)
+        band_keys = [(band, signature[band * rows:(band + 1) * rows].tobytes()) for band in range(bands)]
+        candidates = {kept_ix for band_key in band_keys for kept_ix in buckets.get(band_key, ())}
+        if any(len(shingles & kept_shingles[kept_ix]) / len(shingles | kept_shingles[kept_ix]) >= threshold for kept_ix in candidates):
+            dropped_positions.append(text_ix)
+            continue
+
+        for band_key in band_keys:
+            buckets.setdefault(band_key, []).append(len(kept_positions))
+        kept_positions.append(text_ix)
+        kept_shingles.append(shingles)
+
+    return kept_positions, dropped_positions
+
+def embed_document_chunks(texts, document_id, metadatas = None, journal = None):
+    logger.info(f"Ariflow - embed_document_chunks - Embedding new chunks of document {document_id}")
+    metadatas = metadatas or [{} for _ in texts]
+
+    # Drop near-duplicate chunks (repeated headers, footers, disclaimers) before they cost embeddings and vectors
+    dedup_report = {'chunks': len(texts), 'dropped': 0, 'tokens_saved': 0}
+    if os.getenv("CHUNK_DEDUP_ENABLED", "true").lower() in ("1", "true", "yes"):
+        kept_positions, dropped_positions = deduplicate_chunks(texts)
+        dropped_texts = [texts[text_ix] for text_ix in dropped_positions]
+        texts = [texts[text_ix] for text_ix in kept_positions]
+        metadatas = [metadatas[text_ix] for text_ix in kept_positions]
+        dedup_report['dropped'] = len(dropped_texts)
+        dedup_report['tokens_saved'] = sum(_count_tokens(dropped_texts))
+        total_tokens = sum(_count_tokens(texts)) + dedup_report['tokens_saved']
+        logger.info(
+            f"Ariflow - embed_document_chunks - Dropped {len(dropped_texts)} of {dedup_report['chunks']} chunks as near-duplicates, "
+            f"saving {dedup_report['tokens_saved']} of {total_tokens} tokens ({100 * dedup_report['tokens_saved'] / max(total_tokens, 1):.1f}%)"
+        )
 
-    # Create a spec for the index
-    spec = ServerlessSpec(cloud="aws", region="us-east-1")
+    # Content-derived IDs; identical chunks collapse onto one vector
+    ids = [_chunk_id(document_id, text) for text in texts]
+    unique_positions = {}
+    for text_ix, vector_id in enumerate(ids):
+        unique_positions.setdefault(vector_id, text_ix)
 
-    pc.create_index(
-        name=index_name,
-        dimension=3072,
-        metric='cosine',
-        spec=spec
+    # Initialize Pinecone client
+    logger.info(f"Ariflow - embed_document_chunks - Pinecone client created")
+    pc = _create_pinecone_client()
+
+    # Pinecone index name and the namespace holding this document's vectors
+    index_name, namespace = _get_pinecone_target(document_id)
+    # A shared index holds other documents too, so a dimension mismatch there is an error rather than a rebuild
+    dimension = _get_embedding_dimension()
+    index, index_created = _ensure_index(pc, index_name, dimension, recreate_on_mismatch = not namespace)
+
+    # Diff the document's chunks against what the index already holds
+    existing_ids = set(_list_vector_ids(index, namespace = namespace))
+    if journal is not None:
+        # Journaled embeddings and upserts only hold for the index, namespace and dimension they were made for
+        journal.bind_target(
+            {'index_name': index_name, 'namespace': namespace, 'model': EMBEDDING_MODEL, 'dimension': dimension},
+            reset = index_created
+        )
+        # Chunks an earlier attempt upserted count as present even while the index listing lags behind
+        resumed_upserts = journal.keys("upserted") & set(unique_positions)
+        journal.skip("upserted", len(resumed_upserts - existing_ids))
+        existing_ids |= resumed_upserts
+    new_ids = [vector_id for vector_id in unique_positions if vector_id not in existing_ids]
+    stale_ids = [vector_id for vector_id in existing_ids if vector_id not in unique_positions]
+    logger.info(
+        f"Ariflow - embed_document_chunks - {len(unique_positions)} chunks for {index_name}: {len(new_ids)} new, "
+        f"{len(unique_positions) - len(new_ids)} unchanged, {len(stale_ids)} stale"
+    )
+    _record_metrics(
+        chunks                  = dedup_report['chunks'],
+        chunks_deduplicated     = dedup_report['dropped'],
+        dedup_tokens_saved      = dedup_report['tokens_saved'],
+        chunks_new              = len(new_ids),
+        chunks_unchanged        = len(unique_positions) - len(new_ids),
+        chunks_stale            = len(stale_ids)
     )
-    logger.info(f"Ariflow - save_data_into_VectorDB - Created new index {index_name}")
 
-    # Wait for index to be initialized
-    while not pc.describe_index(index_name).status['ready']:
-        time.sleep(1)
+    # Only new or changed chunks are embedded
+    new_texts = [texts[unique_positions[vector_id]] for vector_id in new_ids]
+    new_metadatas = [metadatas[unique_positions[vector_id]] for vector_id in new_ids]
+    embeddings = []
+    if new_texts:
+        embedding_model = _create_embedding_model()
+        embedding_store = None
+        on_batch = None
+
+        if journal is not None:
+            # Vectors of batches finished by an earlier attempt are read back from an embedding store, which
+            # is the shared cache when enabled and otherwise a store private to this document
+            embedding_store = _get_embedding_store(embedding_model) or EmbeddingStore(
+                str(journal.state_dir / "embeddings" / _embedding_store_name(embedding_model))
+            )
+            journal.skip("embedded", len(journal.keys("embedded") & set(new_ids)))
+            on_batch = lambda batch, batch_embeddings: journal.record("embedded", {new_ids[text_ix]: None for text_ix in batch})
+
+        embeddings = create_embeddings_in_batches(embedding_model, new_texts, embedding_store = embedding_store, on_batch = on_batch)
+
+        # Print the length of embeddings and the size of the first embedding vector
+        logger.info(f"Ariflow - embed_document_chunks - Total embeddings generated: {len(embeddings)}")
+        logger.info(f"Ariflow - embed_document_chunks - Size of first embedding: {len(embeddings[0])}")
+
+    return {
+        'index_name'    : index_name,
+        'namespace'     : namespace,
+        'new_ids'       : new_ids,
+        'new_texts'     : new_texts,
+        'new_metadatas' : new_metadatas,
+        'stale_ids'     : stale_ids,
+        'dedup'         : dedup_report,
+        'embeddings'    : embeddings
+    }
+
+def upsert_document_chunks(embedding_plan, document_id, journal = None):
+    index_name = embedding_plan['index_name']
+    namespace = embedding_plan['namespace']
+    index = _create_pinecone_client().Index(index_name)
+
+    # Upsert the vectors computed above; the retriever reads the chunk back from metadata["text"]
+    if embedding_plan['new_ids']:
+        vectors = [
+            {'id': vector_id, 'values': embedding, 'metadata': {**metadata, 'text': text, 'id': vector_id, 'document_id': document_id}}
+            for vector_id, text, metadata, embedding in zip(
+                embedding_plan['new_ids'], embedding_plan['new_texts'], embedding_plan['new_metadatas'], embedding_plan['embeddings']
+            )
+        ]
+        on_batch = None
+        if journal is not None:
+            # Skip vectors an earlier attempt of this stage already upserted
+            upserted_ids = journal.keys("upserted")
+            journal.skip("upserted", sum(1 for vector in vectors if vector['id'] in upserted_ids))
+            vectors = [vector for vector in vectors if vector['id'] not in upserted_ids]
+            on_batch = lambda batch_ids: journal.record("upserted", dict.fromkeys(batch_ids))
+        _upsert_vectors(index, vectors, namespace = namespace, on_batch = on_batch)
+        logger.info(f"Ariflow - upsert_document_chunks - Upserted {len(vectors)} vectors into Pinecone index {index_name}")
+
+    # Remove vectors whose text is no longer part of the document, after the new ones are in place
+    if embedding_plan['stale_ids']:
+        _delete_vectors(index, embedding_plan['stale_ids'], namespace = namespace)
+        logger.info(f"Ariflow - upsert_document_chunks - Deleted {len(embedding_plan['stale_ids'])} stale vectors from Pinecone index {index_name}")
 
-    # Connect to the index
-    index = pc.Index(index_name)
+def save_data_into_VectorDB(markdown_file_path, images_folder_path, tables_folder_path, document_id):
+    logger.info(f"Ariflow - save_data_into_VectorDB - Storing embeddings into vector database")
 
-    time.sleep(1)
-    # view index stats
-    index.describe_index_stats()
+    # Progress is journaled so a retry resumes where a failed attempt stopped
+    journal = DocumentJournal(document_id)
+    summaries, document_dict = summarize_document(images_folder_path, tables_folder_path, document_id, journal)
 
-    # Create unique IDs for each document
-    ids = [str(uuid.uuid4()) for _ in range(len(texts))]  # Use consistent IDs if overwriting is needed
+    # Prepare text data for embedding (extract the actual text from chunks)
+    logger.info(f"Ariflow - save_data_into_VectorDB - Preparing text for embeddings")
+    chunk_texts, chunk_metadatas = _load_markdown_chunks(markdown_file_path)
+    texts = chunk_texts + summaries
+    metadatas = chunk_metadatas + [{} for _ in summaries]
 
-    # Convert text data into Langchain Document objects
-    docs = [Document(page_content=texts[i], metadata={"id": ids[i]}) for i in range(len(texts))]
-    
-    docsearch = PineconeVectorStore.from_documents(docs, embedding_model, index_name=index_name)
-    logger.info(f"Ariflow - save_data_into_VectorDB - Upserted vectors into Pinecone using PineconeVectorStore")
-    print(f"Upserted vectors into Pinecone using PineconeVectorStore.")
+    embedding_plan = embed_document_chunks(texts, document_id, metadatas, journal)
+    upsert_document_chunks(embedding_plan, document_id, journal)
+    journal.finish()
 
     return document_dict
+
+# Optional single-file bundle of a document's parsed outputs: magic, payloads back to back, a JSON index
+# {name: [offset, length]} and a fixed footer (index offset, index length, magic), so a reader can fetch
+# one artifact with a footer read, an index read and a payload read. backend/bundle.py reads this format
+ARTIFACT_BUNDLE_MAGIC = b"ADBUNDL1"
+ARTIFACT_BUNDLE_FOOTER = struct.Struct("<QQ8s")
+ARTIFACT_BUNDLE_FILENAME = "artifacts.bundle"
+
+def _artifact_bundle_enabled():
+    return os.getenv("ARTIFACT_BUNDLE_ENABLED", "false").lower() in ("1", "true", "yes")
+
+def _collect_parsed_artifacts(parsed_document_dir):
+    # Every parsed output except hidden bookkeeping (.shards, manifests), named by its path inside parsed_documents
+    for path in sorted(Path(parsed_document_dir).rglob("*")):
+        relative_path = path.relative_to(parsed_document_dir)
+        if path.is_file() and not any(part.startswith('.') for part in relative_path.parts):
+            yield relative_path.as_posix(), path
+
+def write_artifact_bundle(bundle_path, artifacts):
+    # artifacts yields (name, bytes or file path) pairs
+    index = {}
+    tmp_path = f"{bundle_path}.tmp"
+    with open(tmp_path, "wb") as fp:
+        fp.write(ARTIFACT_BUNDLE_MAGIC)
+        for name, source in artifacts:
+            offset = fp.tell()
+            if isinstance(source, bytes):
+                fp.write(source)
+            else:
+                with open(source, "rb") as source_fp:
+                    shutil.copyfileobj(source_fp, fp)
+            index[name] = [offset, fp.tell() - offset]
+
+        index_offset = fp.tell()
+        index_bytes = json.dumps(index).encode("utf-8")
+        fp.write(index_bytes)
+        fp.write(ARTIFACT_BUNDLE_FOOTER.pack(index_offset, len(index_bytes), ARTIFACT_BUNDLE_MAGIC))
+    os.replace(tmp_path, bundle_path)
+
+    logger.info(f"Ariflow - write_artifact_bundle - Wrote {len(index)} artifacts ({os.path.getsize(bundle_path) / (1024 * 1024):.2f} MB) to {bundle_path}")
+    return index
+
+def _publish_document_summaries(document_id, document_id_dir, document_dict, images_folder_path = None, tables_folder_path = None, s3_client = None):
+    # Load images and tables summaries into JSON file
+    json_file_path = document_id_dir / "doc_files_summaries.json"
+    with open(json_file_path, "w") as json_file:
+        json.dump(document_dict, json_file)
+    logger.info(f"Document summaries for document ID {document_id} written to JSON")
+
+    # Upload JSON to S3
+    max_workers = int(os.getenv("S3_UPLOAD_WORKERS", 16))
+    if s3_client is None:
+        s3_client = _create_s3_client(max_pool_connections = max_workers)
+    s3_key = f"{document_id}/doc_files_summaries"
+    s3_client.upload_file(str(json_file_path), os.getenv("S3_BUCKET_NAME"), s3_key)
+    _record_metrics(s3_put_requests = 1, upload_bytes = os.path.getsize(json_file_path))
+    logger.info(f"JSON file uploaded to S3 at {s3_key} for document ID {document_id}")
+
+    # Cleanup local JSON file after upload
+    os.remove(json_file_path)
+    logger.info(f"Local JSON file removed for document ID {document_id}")
+
+    # Ship every parsed output as one bundle object instead of one object per file
+    if _artifact_bundle_enabled():
+        # Built outside the document dir and removed once uploaded, so it never becomes part of the document
+        with tempfile.TemporaryDirectory() as bundle_dir:
+            bundle_path = Path(bundle_dir) / ARTIFACT_BUNDLE_FILENAME
+            artifacts = list(_collect_parsed_artifacts(document_id_dir / "parsed_documents"))
+            artifacts.append(("doc_files_summaries", json.dumps(document_dict).encode("utf-8")))
+            write_artifact_bundle(bundle_path, artifacts)
+
+            s3_key = f"{document_id}/{ARTIFACT_BUNDLE_FILENAME}"
+            s3_client.upload_file(str(bundle_path), os.getenv("S3_BUCKET_NAME"), s3_key)
+            _record_metrics(s3_put_requests = 1, upload_bytes = os.path.getsize(bundle_path))
+            logger.info(f"Artifact bundle uploaded to S3 at {s3_key} for document ID {document_id}")
+        return
+
+    # Upload all images and tables to S3 on a bounded pool, skipping files whose ETag already matches
+    files = []
+    prefixes = []
+    for folder_path, folder_name in ((images_folder_path, "images"), (tables_folder_path, "tables")):
+        if folder_path:
+            prefixes.append(f"{document_id}/{folder_name}/")
+            files.extend(
+                (file_path, f"{document_id}/{folder_name}/{file_path.name}")
+                for file_path in folder_path.iterdir() if file_path.is_file()
+            )
+    if files:
+        _upload_s3_objects(s3_client, os.getenv("S3_BUCKET_NAME"), files, prefixes, max_workers)
+
+def _find_parsed_outputs(parsed_document_dir):
+    markdown_file_path = None
+    images_folder_path = None
+    tables_folder_path = None
+
+    if parsed_document_dir.is_dir():
+        for file in os.listdir(parsed_document_dir):
+            # Skip hidden files and folders (like .DS_Store or .shards)
+            if file.startswith('.'):
+                continue
+            if file.endswith(".md"):
+                markdown_file_path = parsed_document_dir / file
+            elif file == "images":
+                images_folder_path = parsed_document_dir / file
+            elif file == "tables":
+                tables_folder_path = parsed_document_dir / file
+
+    return markdown_file_path, images_folder_path, tables_folder_path
+
+# Per-document stages. Each stage reads what the previous one left in <document_id>/.pipeline,
+# so a document can move through the pipeline on its own while other documents are still downloading
+PIPELINE_STATE_DIRNAME = ".pipeline"
+
+def _get_document_dir(document_id):
+    return Path(os.path.join(os.getcwd(), os.getenv("DOWNLOAD_DIRECTORY", "downloads"), document_id))
+
+def _write_stage_output(document_id, filename, data):
+    state_dir = _get_document_dir(document_id) / PIPELINE_STATE_DIRNAME
+    state_dir.mkdir(parents=True, exist_ok=True)
+    tmp_path = state_dir / f"{filename}.tmp"
+    with open(tmp_path, "w") as fp:
+        json.dump(data, fp)
+    os.replace(tmp_path, state_dir / filename)
+
+def _read_stage_output(document_id, filename):
+    state_path = _get_document_dir(document_id) / PIPELINE_STATE_DIRNAME / filename
+    if not state_path.is_file():
+        raise FileNotFoundError(f"Missing {state_path}; run the previous stage for document {document_id} first")
+    with open(state_path, "r") as fp:
+        return json.load(fp)
+
+class DocumentJournal:
+    # Append-only progress journal of one document in <document_id>/.pipeline/journal.jsonl. Lines record items
+    # that finished a step ("summarized" image files with their summary, "embedded" and "upserted" chunk IDs) or
+    # how many items an attempt skipped thanks to them. A retry reads it back and skips that work; the journal
+    # is removed once the document is fully upserted. Stages running in separate tasks share it through the file.
+    # "target" lines bind the embedding steps to the index, namespace, model and dimension they were done for
+
+    STEPS = ("summarized", "embedded", "upserted")
+    TARGET_STEPS = ("embedded", "upserted")
+
+    def __init__(self, document_id):
+        self.document_id = document_id
+        self.state_dir = _get_document_dir(document_id) / PIPELINE_STATE_DIRNAME
+        self.path = self.state_dir / "journal.jsonl"
+        self._lock = threading.Lock()
+        self._entries = {step: {} for step in self.STEPS}
+        self._skipped = {step: 0 for step in self.STEPS}
+        self.target = None
+
+        if self.path.is_file():
+            with open(self.path, "r+b") as fp:
+                # Cut a torn last line left by an interrupted write, so new records start on a fresh line
+                content = fp.read()
+                if content and not content.endswith(b"\n"):
+                    fp.truncate(content.rfind(b"\n") + 1)
+                    content = content[:content.rfind(b"\n") + 1]
+
+            for line in content.decode("utf-8").splitlines():
+                record = json.loads(line)
+                if 'target' in record:
+                    for step in record['reset']:
+                        self._entries[step].clear()
+                    self.target = record['target']
+                elif 'skipped' in record:
+                    self._skipped[record['step']] += record['skipped']
+                else:
+                    self._entries[record['step']].update(record['items'])
+            logger.info(
+                f"Ariflow - DocumentJournal - Resuming document {document_id}: "
+                + ", ".join(f"{len(self._entries[step])} {step}" for step in self.STEPS)
+            )
+
+    def get(self, step, key):
+        return self._entries[step].get(key)
+
+    def keys(self, step):
+        return set(self._entries[step])
+
+    def _append(self, record):
+        self.state_dir.mkdir(parents=True, exist_ok=True)
+        with open(self.path, "a") as fp:
+            fp.write(json.dumps(record) + "\n")
+            fp.flush()
+            os.fsync(fp.fileno())
+
+    def record(self, step, items):
+        # items maps each finished key to what a retry needs to reuse it (None when the key is enough)
+        if not items:
+            return
+        with self._lock:
+            self._append({'step': step, 'items': items})
+            self._entries[step].update(items)
+
+    def bind_target(self, target, reset = False):
+        # Entries of an earlier attempt against another target, or against an index that has since been
+        # recreated, describe vectors that are not there; drop them so that work is done again
+        with self._lock:
+            if target == self.target and not reset:
+                return
+            reset_steps = [step for step in self.TARGET_STEPS if self._entries[step]]
+            self._append({'target': target, 'reset': reset_steps})
+            for step in reset_steps:
+                self._entries[step].clear()
+            self.target = target
+
+        if reset_steps:
+            logger.info(f"Ariflow - DocumentJournal - Dropped journaled {', '.join(reset_steps)} entries of document {self.document_id}, bound to {target}")
+
+    def skip(self, step, count = 1):
+        if not count:
+            return
+        with self._lock:
+            self._append({'step': step, 'skipped': count})
+            self._skipped[step] += count
+
+    def finish(self):
+        report = {
+            'document_id'   : self.document_id,
+            'steps'         : {step: {'completed': len(self._entries[step]), 'skipped': self._skipped[step]} for step in self.STEPS}
+        }
+        _write_stage_output(self.document_id, "resume_report.json", report)
+        logger.info(
+            f"Ariflow - DocumentJournal - Document {self.document_id} done, work skipped by resuming: "
+            + ", ".join(f"{self._skipped[step]} {step}" for step in self.STEPS)
+        )
+
+        if self.path.is_file():
+            os.remove(self.path)
+        shutil.rmtree(self.state_dir / "embeddings", ignore_errors = True)
+        return report
+
+def _journal_file_key(folder_path, filename):
+    # Re-parsing rewrites the file, which changes the key and invalidates the journal entry
+    file_stat = os.stat(os.path.join(folder_path, filename))
+    return f"{Path(folder_path).name}/{filename}:{file_stat.st_size}:{file_stat.st_mtime_ns}"
+
+# Stage names used in the metrics files and reports, in the order DOCUMENT_STAGES runs them
+DOCUMENT_STAGE_NAMES = ["download", "parse", "summarize", "embed", "upsert"]
+
+def _stage_metrics_filename(stage_name):
+    return f"metrics_{stage_name}.json"
+
+def _read_stage_metrics(document_id, stage_name):
+    try:
+        return _read_stage_output(document_id, _stage_metrics_filename(stage_name))
+    except (FileNotFoundError, ValueError):
+        return None
+
+@contextmanager
+def _measure_stage(document_id, stage_name, new_run = False):
+    # Times one stage of one document and stores its counters in <document_id>/.pipeline/metrics_<stage>.json,
+    # so stages that ran as separate Airflow tasks, in separate processes, end up in one document report
+    global _STAGE_METRICS
+    previous_metrics = _read_stage_metrics(document_id, stage_name)
+    if new_run and (previous_metrics is None or previous_metrics['status'] == "succeeded"):
+        # The first stage after a finished one starts a new run of the document; a failed one is being retried
+        for metrics_name in DOCUMENT_STAGE_NAMES + ["report"]:
+            metrics_path = _get_document_dir(document_id) / PIPELINE_STATE_DIRNAME / _stage_metrics_filename(metrics_name)
+            if metrics_path.is_file():
+                os.remove(metrics_path)
+        previous_metrics = None
+
+    with _STAGE_METRICS_LOCK:
+        _STAGE_METRICS = {}
+    started_at = time.time()
+    start_time = time.perf_counter()
+    status = "failed"
+    try:
+        yield
+        status = "succeeded"
+    finally:
+        with _STAGE_METRICS_LOCK:
+            counters, _STAGE_METRICS = _STAGE_METRICS, None
+        stage_metrics = {
+            'document_id'           : document_id,
+            'stage'                 : stage_name,
+            'status'                : status,
+            'attempts'              : previous_metrics['attempts'] + 1 if previous_metrics else 1,
+            'started_at'            : started_at,
+            'duration_seconds'      : time.perf_counter() - start_time,
+            # High-water marks of this process and of the worker processes it waited for, not per-stage deltas
+            'peak_rss_mb'           : resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            'peak_worker_rss_mb'    : resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+            'counters'              : counters,
+            # Process-wide state of the OpenAI limiters when the stage ended
+            'openai_rate_limiters'  : openai_rate_limiter_stats()
+        }
+        _write_stage_output(document_id, _stage_metrics_filename(stage_name), stage_metrics)
+        logger.info(
+            f"Ariflow - _measure_stage - Stage {stage_name} of document {document_id} {status} in {stage_metrics['duration_seconds']:.2f}s: "
+            + (", ".join(f"{name}={value:g}" for name, value in sorted(counters.items())) or "no counters")
+        )
+
+def _sum_counters(counter_dicts):
+    totals = {}
+    for counters in counter_dicts:
+        for name, value in counters.items():
+            totals[name] = totals.get(name, 0) + value
+    return totals
+
+def write_document_metrics_report(document_id):
+    # Puts the stage metrics of one document together into <document_id>/.pipeline/metrics_report.json
+    stages = {}
+    for stage_name in DOCUMENT_STAGE_NAMES:
+        stage_metrics = _read_stage_metrics(document_id, stage_name)
+        if stage_metrics is not None:
+            stages[stage_name] = stage_metrics
+
+    if any(stage_metrics['status'] == "failed" for stage_metrics in stages.values()):
+        status = "failed"
+    elif len(stages) < len(DOCUMENT_STAGE_NAMES):
+        status = "incomplete"
+    else:
+        status = "succeeded"
+
+    report = {
+        'document_id'       : document_id,
+        'status'            : status,
+        'started_at'        : min((stage_metrics['started_at'] for stage_metrics in stages.values()), default = None),
+        'finished_at'       : max((stage_metrics['started_at'] + stage_metrics['duration_seconds'] for stage_metrics in stages.values()), default = None),
+        'duration_seconds'  : sum(stage_metrics['duration_seconds'] for stage_metrics in stages.values()),
+        'stages'            : stages,
+        'totals'            : _sum_counters(stage_metrics['counters'] for stage_metrics in stages.values())
+    }
+    _write_stage_output(document_id, _stage_metrics_filename("report"), report)
+    return report
+
+def write_run_metrics_report(document_ids, run_id = None):
+    # One report for a whole run: per-stage durations and counters summed over its documents, plus every document report
+    run_id = run_id or time.strftime("%Y%m%dT%H%M%SZ", time.gmtime())
+    document_reports = {document_id: write_document_metrics_report(document_id) for document_id in document_ids}
+
+    stages = {}
+    for stage_name in DOCUMENT_STAGE_NAMES:
+        stage_metrics = [report['stages'][stage_name] for report in document_reports.values() if stage_name in report['stages']]
+        stages[stage_name] = {
+            'documents'         : len(stage_metrics),
+            'failed'            : sum(1 for metrics in stage_metrics if metrics['status'] == "failed"),
+            'duration_seconds'  : sum(metrics['duration_seconds'] for metrics in stage_metrics),
+            'max_duration_seconds': max((metrics['duration_seconds'] for metrics in stage_metrics), default = 0.0),
+            'counters'          : _sum_counters(metrics['counters'] for metrics in stage_metrics)
+        }
+
+    started_at = [report['started_at'] for report in document_reports.values() if report['started_at'] is not None]
+    finished_at = [report['finished_at'] for report in document_reports.values() if report['finished_at'] is not None]
+    report = {
+        'run_id'            : run_id,
+        'documents'         : len(document_reports),
+        'succeeded'         : sorted(document_id for document_id, report in document_reports.items() if report['status'] == "succeeded"),
+        'failed'            : sorted(document_id for document_id, report in document_reports.items() if report['status'] != "succeeded"),
+        # Stages of different documents overlap in Airflow, so wall time is shorter than the summed stage durations
+        'wall_seconds'      : max(finished_at) - min(started_at) if started_at else 0.0,
+        'stage_seconds'     : sum(stage['duration_seconds'] for stage in stages.values()),
+        'stages'            : stages,
+        'totals'            : _sum_counters(stage['counters'] for stage in stages.values()),
+        'document_reports'  : document_reports
+    }
+
+    reports_dir = Path(os.getenv("RUN_METRICS_DIR", os.path.join(os.getcwd(), os.getenv("DOWNLOAD_DIRECTORY", "downloads"), ".run_reports")))
+    reports_dir.mkdir(parents=True, exist_ok=True)
+    report_path = reports_dir / f"{re.sub(r'[^A-Za-z0-9._-]', '_', run_id)}.json"
+    tmp_path = reports_dir / f"{report_path.name}.tmp"
+    with open(tmp_path, "w") as fp:
+        json.dump(report, fp, indent = 2)
+    os.replace(tmp_path, report_path)
+
+    logger.info(
+        f"Ariflow - write_run_metrics_report - Run {run_id}: {len(report['succeeded'])}/{report['documents']} documents succeeded "
+        f"in {report['wall_seconds']:.1f}s - "
+        + ", ".join(f"{stage_name} {stage['duration_seconds']:.1f}s" for stage_name, stage in stages.items())
+        + f" - report written to {report_path}"
+    )
+    return report
+
+def download_document_stage(document_id):
+    logger.info(f"Ariflow - download_document_stage - Downloading document {document_id}")
+    with _measure_stage(document_id, "download", new_run = True):
+        return download_files_from_s3(os.getenv("S3_BUCKET_NAME"), f"{document_id}/")
+
+def parse_document_stage(document_id):
+    logger.info(f"Ariflow - parse_document_stage - Parsing document {document_id}")
+    with _measure_stage(document_id, "parse"):
+        doc_parser_driver_func(document_ids = [document_id])
+
+def summarize_document_stage(document_id):
+    logger.info(f"Ariflow - summarize_document_stage - Summarizing images and tables of document {document_id}")
+    with _measure_stage(document_id, "summarize"):
+        _, images_folder_path, tables_folder_path = _find_parsed_outputs(_get_document_dir(document_id) / "parsed_documents")
+        summaries, document_dict = summarize_document(images_folder_path, tables_folder_path, document_id, DocumentJournal(document_id))
+        _write_stage_output(document_id, "summaries.json", {'summaries': summaries, 'document_dict': document_dict})
+
+def embed_document_stage(document_id):
+    logger.info(f"Ariflow - embed_document_stage - Embedding document {document_id}")
+    with _measure_stage(document_id, "embed"):
+        markdown_file_path, _, _ = _find_parsed_outputs(_get_document_dir(document_id) / "parsed_documents")
+        if markdown_file_path is None:
+            raise FileNotFoundError(f"No parsed markdown found for document {document_id}")
+
+        summaries = _read_stage_output(document_id, "summaries.json")['summaries']
+        chunk_texts, chunk_metadatas = _load_markdown_chunks(markdown_file_path)
+        embedding_plan = embed_document_chunks(chunk_texts + summaries, document_id, chunk_metadatas + [{} for _ in summaries], DocumentJournal(document_id))
+
+        # Vectors go to a binary file next to the plan instead of into JSON
+        embeddings = np.asarray(embedding_plan.pop('embeddings'), dtype = np.float32)
+        np.save(_get_document_dir(document_id) / PIPELINE_STATE_DIRNAME / "embeddings.npy", embeddings)
+        _write_stage_output(document_id, "embedding_plan.json", embedding_plan)
+
+def upsert_document_stage(document_id):
+    logger.info(f"Ariflow - upsert_document_stage - Upserting document {document_id}")
+    with _measure_stage(document_id, "upsert"):
+        document_id_dir = _get_document_dir(document_id)
+        embeddings_path = document_id_dir / PIPELINE_STATE_DIRNAME / "embeddings.npy"
+
+        embedding_plan = _read_stage_output(document_id, "embedding_plan.json")
+        embedding_plan['embeddings'] = np.load(embeddings_path).tolist()
+        journal = DocumentJournal(document_id)
+        upsert_document_chunks(embedding_plan, document_id, journal)
+        logger.info(f"Ariflow - upsert_document_stage - Data for document_id {document_id} stored to Pinecone vectorDB successfully")
+
+        document_dict = _read_stage_output(document_id, "summaries.json")['document_dict']
+        _, images_folder_path, tables_folder_path = _find_parsed_outputs(document_id_dir / "parsed_documents")
+        _publish_document_summaries(document_id, document_id_dir, document_dict, images_folder_path, tables_folder_path)
+        os.remove(embeddings_path)
+        journal.finish()
+
+DOCUMENT_STAGES = [
+    download_document_stage,
+    parse_document_stage,
+    summarize_document_stage,
+    embed_document_stage,
+    upsert_document_stage
+]
+
+def process_document(document_id):
+    for stage in DOCUMENT_STAGES:
+        stage(document_id)
+    logger.info(f"Ariflow - process_document - Document {document_id} processed through all stages")
+
 def vectorDB_driver_func():
     logger.info("Ariflow - vectorDB_driver_func - vectorDB driver function")
     file_dir = Path(os.path.join(os.getcwd(), os.getenv("DOWNLOAD_DIRECTORY")))
     markdown_fname = None
 
+    # One client shared by every document's uploads
+    s3_client = _create_s3_client(max_pool_connections = int(os.getenv("S3_UPLOAD_WORKERS", 16)))
+
     for document_id_dir in file_dir.iterdir():
         if document_id_dir.is_dir() and not document_id_dir.name.startswith('.'):
             # Extract document_id from the directory name
@@ -453,33 +2799,27 @@ def vectorDB_driver_func():
             document_dict = save_data_into_VectorDB(markdown_file_path, images_folder_path, tables_folder_path, document_id)
             logger.info(f"Ariflow - vectorDB_driver_func - Data for document_id {document_id} stored to Pinecone vectorDB successfully")
 
-            
-            # Load images and tables summaries into JSON file
-            json_file_path = document_id_dir / "doc_files_summaries.json"
-            with open(json_file_path, "w") as json_file:
-                json.dump(document_dict, json_file)
-            logger.info(f"Document summaries for document ID {document_id} written to JSON")
-
-            # Upload JSON to S3
-            s3_client = boto3.client(
-                's3',
-                aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
-                aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY")
-            )
-            s3_key = f"{document_id}/doc_files_summaries"
-            s3_client.upload_file(str(json_file_path), os.getenv("S3_BUCKET_NAME"), s3_key)
-            logger.info(f"JSON file uploaded to S3 at {s3_key} for document ID {document_id}")
-
-            # Cleanup local JSON file after upload
-            os.remove(json_file_path)
-            logger.info(f"Local JSON file removed for document ID {document_id}")
+            # Write the image and table summaries and upload them to S3
+            _publish_document_summaries(document_id, document_id_dir, document_dict, images_folder_path, tables_folder_path, s3_client)
 
     logger.info("All document data stored to JSON and uploaded to S3.")
 
 def main():
-    download_files_from_s3_driver_func()
-    doc_parser_driver_func()
-    vectorDB_driver_func()
+    # Each document goes through download -> parse -> summarize -> embed -> upsert on its own;
+    # a failing document does not stop the others
+    failed_documents = {}
+    document_ids = discover_document_ids()
+    for document_id in document_ids:
+        try:
+            process_document(document_id)
+        except Exception as e:
+            logger.error(f"Ariflow - main - Error processing document {document_id}: {e}")
+            failed_documents[document_id] = f"{type(e).__name__}: {e}"
+
+    write_run_metrics_report(document_ids)
+
+    if failed_documents:
+        raise RuntimeError(f"Failed to process {len(failed_documents)} documents: {failed_documents}")
 
 if __name__ == '__main__':
     main()   
@@ -0,0 +1,75 @@
+# --- Reader for the artifact bundles written by the ingestion pipeline ---
+# --- A bundle packs every parsed output of a document into one file with an offset index ---
+
+import json
+import mmap
+import struct
+
+# Layout: magic, payloads back to back, JSON index {name: [offset, length]},
+# then a footer (index offset, index length, magic)
+BUNDLE_MAGIC = b"ADBUNDL1"
+_BUNDLE_FOOTER = struct.Struct("<QQ8s")
+
+class ArtifactBundle:
+    """ Read single artifacts out of a bundle through a local mmap or S3 range reads, without unpacking it. """
+
+    def __init__(self, read_range, size, close = None):
+        self._read_range = read_range
+        self._close = close
+
+        if size < len(BUNDLE_MAGIC) + _BUNDLE_FOOTER.size:
+            raise ValueError("File is too small to be an artifact bundle")
+
+        index_offset, index_length, magic = _BUNDLE_FOOTER.unpack(read_range(size - _BUNDLE_FOOTER.size, _BUNDLE_FOOTER.size))
+        if magic != BUNDLE_MAGIC or index_offset + index_length > size - _BUNDLE_FOOTER.size:
+            raise ValueError("File is not a valid artifact bundle")
+
+        self.index = json.loads(read_range(index_offset, index_length))
+
+    @classmethod
+    def from_file(cls, path: str):
+        """ Open a local bundle; artifacts are sliced out of a read-only memory map. """
+
+        with open(path, "rb") as file:
+            mapped = mmap.mmap(file.fileno(), 0, access = mmap.ACCESS_READ)
+
+        return cls(lambda offset, length: mapped[offset:offset + length], len(mapped), mapped.close)
+
+    @classmethod
+    def from_s3(cls, s3_client, bucket_name: str, key: str):
+        """ Open a bundle stored in S3; every read is a single ranged GET. """
+
+        size = s3_client.head_object(Bucket = bucket_name, Key = key)["ContentLength"]
+
+        def read_range(offset, length):
+            response = s3_client.get_object(Bucket = bucket_name, Key = key, Range = f"bytes={offset}-{offset + length - 1}")
+            return response["Body"].read()
+
+        return cls(read_range, size)
+
+    def names(self):
+        """ Names of all artifacts, as paths relative to the parsed_documents folder. """
+
+        return list(self.index)
+
+    def __contains__(self, name: str):
+        return name in self.index
+
+    def read(self, name: str) -> bytes:
+        """ Return the bytes of one artifact. """
+
+        offset, length = self.index[name]
+        if length == 0:
+            return b""
+        return self._read_range(offset, length)
+
+    def close(self):
+        if self._close is not None:
+            self._close()
+            self._close = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -15,9 +15,17 @@ from io import BytesIO
 
 # Custom imports
 from state import AgentState
+from bundle import ArtifactBundle
 
 load_dotenv()
 
+def get_pinecone_target(document_id: str):
+    """Return the (index name, namespace) holding a document's vectors, matching the ingestion pipeline."""
+
+    if os.getenv("PINECONE_INDEX_MODE", "per_document").lower() == "shared":
+        return os.getenv("PINECONE_SHARED_INDEX_NAME", "documents-index"), document_id
+    return f"{document_id}-doc-index", ""
+
 @tool
 def RetrieveFromPinecone(queries: List[str]):
     """Retrieve documents from Pinecone based on the user's query."""
@@ -44,7 +52,8 @@ async def retrieve_node(state: AgentState, config: RunnableConfig):
         with open("sourcedocument", 'r', encoding='utf-8') as file:
             index_name = str(file.read())
 
-    pinecone_index = pinecone.Index(str(index_name + "-doc-index"))
+    pinecone_index_name, namespace = get_pinecone_target(str(index_name))
+    pinecone_index = pinecone.Index(pinecone_index_name)
 
     ai_message = cast(AIMessage, state["messages"][-1])
     state["resources"] = state.get("resources", [])
@@ -62,16 +71,26 @@ async def retrieve_node(state: AgentState, config: RunnableConfig):
         })
     await copilotkit_emit_state(config, state)
 
+    # Queries must be embedded at the dimension the ingestion pipeline used for the index
+    embedding_dimensions = int(os.getenv("EMBEDDING_DIMENSIONS", 3072))
     embeddings = OpenAIEmbeddings(
-        model   = "text-embedding-3-large", 
-        api_key = os.getenv("OPENAI_API_KEY")
+        model       = "text-embedding-3-large", 
+        api_key     = os.getenv("OPENAI_API_KEY"),
+        dimensions  = embedding_dimensions if embedding_dimensions != 3072 else None
     )
 
     # Prepare loading images
     dir_path = os.path.join(os.getcwd(), 'downloads', index_name)
 
-    with open(os.path.join(dir_path, "doc_files_summaries"), 'r', encoding="utf-8") as json_file:
-        parsed_json = json.load(json_file)
+    # Prefer the packed artifact bundle when ingestion produced one
+    bundle = None
+    bundle_path = os.path.join(dir_path, "artifacts.bundle")
+    if os.path.isfile(bundle_path):
+        bundle = ArtifactBundle.from_file(bundle_path)
+        parsed_json = json.loads(bundle.read("doc_files_summaries"))
+    else:
+        with open(os.path.join(dir_path, "doc_files_summaries"), 'r', encoding="utf-8") as json_file:
+            parsed_json = json.load(json_file)
     
     for i, query in enumerate(queries):
         # Convert queries to embeddings
@@ -81,7 +100,8 @@ async def retrieve_node(state: AgentState, config: RunnableConfig):
         results = pinecone_index.query(
             vector=[query_vector], 
             top_k=5, 
-            include_metadata=True
+            include_metadata=True,
+            namespace=namespace
         )
     
         # If relevant chunks found, append to resources
@@ -109,10 +129,15 @@ async def retrieve_node(state: AgentState, config: RunnableConfig):
                     print("FILENAME:", filename)
 
                     # Load the image and convert to base64
-                    if os.path.exists(image_path):
+                    image_data = None
+                    if bundle is not None and f"tables/{filename}" in bundle:
+                        image_data = bundle.read(f"tables/{filename}")
+                    elif os.path.exists(image_path):
                         with open(image_path, "rb") as image_file:
                             image_data = image_file.read()
-                            base64_image = base64.b64encode(image_data).decode('utf-8')
+
+                    if image_data is not None:
+                        base64_image = base64.b64encode(image_data).decode('utf-8')
 
                         # Append the base64 image to the resources
                         resources[-1].update({
@@ -137,6 +162,9 @@ async def retrieve_node(state: AgentState, config: RunnableConfig):
         state["logs"][i]["done"] = True
         await copilotkit_emit_state(config, state)
 
+    if bundle is not None:
+        bundle.close()
+
     # Add to state if relevant context was found
     if resources:
         state["resources"].extend(resources)